@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Benchmark of the parsing of the getListMessages SEARCH response.
+
+Compares the incremental parser (owalib.iterParseMessages) with the regular
+expressions used before (see parseRegexp below) on a generated multistatus
+response. Reports the total time, the time until the first message is 
+available and the peak memory usage. Each parser runs in its own process so 
+the peak memory usage can be measured.
+
+Usage: bench_listing.py [number of messages (default 50000)]
+"""
+
+import os
+import sys
+import re
+import time
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import owalib
+
+RESPONSE_ITEM = """<a:response><a:href>https://xxx.dddddd.com/exchange/domainuser/Inbox/Message%(i)i.EML</a:href>\
+<a:propstat><a:status>HTTP/1.1 200 OK</a:status><a:prop>\
+<d:fromemail>sender%(s)i@dddddd.com</d:fromemail><d:subject>RE: Subject of message %(i)i</d:subject>\
+<d:read b:dt="boolean">0</d:read></a:prop></a:propstat></a:response>"""
+
+def writeResponse(_file, _count):
+    """
+    Write a multistatus response with _count messages to the file _file.
+    """
+    _file.write('<?xml version="1.0"?><a:multistatus xmlns:b="urn:uuid:c2f41010-65b3-11d1-a29f-00aa00c14882/" '
+                'xmlns:d="urn:schemas:httpmail:" xmlns:c="xml:" xmlns:a="DAV:">')
+    for i in xrange(_count):
+        _file.write(RESPONSE_ITEM % {'i': i, 's': i % 100})
+    _file.write('</a:multistatus>')
+
+def parseRegexp(_file):
+    """
+    The parsing of the getListMessages response before the incremental parser.
+    Returns the list of messages and the time at which the first message was available.
+    """
+    xml = _file.read()
+    a = re.compile(r'<a:response>(.+?)</a:response>')
+    b = re.compile(r'<a:href>(?P<href>.+?)</a:href>.*?<d:fromemail>(?P<fromemail>.+?)</d:fromemail>.*?(<d:subject>(?P<subject>.*?)</d:subject>|<d:subject/>)')
+    messages = []
+    for item in a.findall(xml):
+        m = b.search(item)
+        if not m:
+            continue
+        mail_dict = {}
+        mail_dict.update(m.groupdict())
+        messages.append( mail_dict )
+    return messages, time.time()
+
+def parseIncremental(_file):
+    """
+    The incremental parser (getListMessages collects the messages in a list).
+    Returns the list of messages and the time at which the first message was available.
+    """
+    messages = []
+    first = None
+    for message in owalib.iterParseMessages(_file):
+        if first is None:
+            first = time.time()
+        messages.append(message)
+    return messages, first
+
+PARSERS = {'regexp': parseRegexp, 'incremental': parseIncremental}
+
+def runParser(_name, _fileName):
+    """
+    Run a single parser and print the time, peak memory and number of messages.
+    """
+    f = open(_fileName, 'rb')
+    start = time.time()
+    messages, first = PARSERS[_name](f)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%s %f %f %i %i' % (_name, elapsed, first - start, maxrss, len(messages))
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--run':
+        runParser(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    count = 50000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    fd, fileName = tempfile.mkstemp('.xml')
+    try:
+        f = os.fdopen(fd, 'wb')
+        writeResponse(f, count)
+        f.close()
+        print 'Response with %i messages (%.1f MB)' % (count, os.path.getsize(fileName) / 1e6)
+
+        for name in ['regexp', 'incremental']:
+            out = subprocess.Popen([sys.executable, __file__, '--run', name, fileName],
+                                   stdout=subprocess.PIPE).communicate()[0]
+            name, elapsed, first, maxrss, found = out.split()
+            print '%-12s %8.3f s total %8.3f s first message %8.1f MB peak RSS %8s messages' % \
+                (name, float(elapsed), float(first), int(maxrss) / 1024.0, found)
+    finally:
+        os.remove(fileName)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Benchmarks of owalib and owafetch against a local fake Exchange server
+(see fakeexchange.py) and SMTP sink (see smtpsink.py).
+
+For each mailbox size the following benchmarks are run:
+ - list:        getListMessages of all messages in a single SEARCH request
+ - list-paged:  iterListMessagePages with pages of --page-size messages
+ - fetch:       getMessageStream of each message over a single connection
+ - fetch-pool:  streamMany over an OWAConnectionPool of --concurrency connections
+ - owafetch:    an owafetch run which forwards all messages to the SMTP sink
+
+Each benchmark runs in its own process, the peak memory usage (RSS) is
+the peak of that process (of owafetch for the owafetch benchmark).
+
+Usage: bench_owalib.py [options] [number of messages ...] (default 1000 10000 100000)
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+import owalib
+import smtpsink
+
+BENCHMARKS = ['list', 'list-paged', 'fetch', 'fetch-pool', 'owafetch']
+
+PROPERTIES = """ExchangeServer = localhost:%(port)i
+ExchangePath = exchange
+Username = user
+Password = password
+Domain = DOMAIN
+DestinationAddress = user@example.com
+MailServer = localhost
+MailServerPort = %(smtpPort)i
+PageSize = %(pageSize)i
+Concurrency = %(concurrency)i
+"""
+
+def connect(_port):
+    """
+    Returns an authenticated connection to the fake server and the inbox path.
+    """
+    owa = owalib.PlainOWAConnection('localhost', _port)
+    owa.doFBA('DOMAIN\\user', 'password', 'exchange', '/exchweb/bin/auth/owaauth.dll')
+    rootPath = owa.getRootPath('exchange')
+    return owa, owa.getInboxPath(rootPath)
+
+def runBenchmark(_name, _port, _options):
+    """
+    Run a single benchmark, returns (number of messages, number of bytes).
+    """
+    if _name == 'owafetch':
+        return runOwafetch(_port, _options)
+
+    owa, inboxPath = connect(_port)
+    if _name == 'list':
+        return len(owa.getListMessages(inboxPath)), 0
+    if _name == 'list-paged':
+        count = 0
+        for page in owa.iterListMessagePages(inboxPath, False, _options['pageSize']):
+            count += len(page)
+        return count, 0
+
+    hrefs = [m['href'] for m in owa.iterListMessages(inboxPath)]
+    if _options['fetchLimit']:
+        hrefs = hrefs[:_options['fetchLimit']]
+    if _name == 'fetch':
+        messages = (owa.getMessageStream(href) for href in hrefs)
+    else:
+        pool = owalib.OWAConnectionPool(owa, _options['concurrency'])
+        messages = (message for href, message in pool.streamMany(hrefs))
+    count = 0
+    size = 0
+    for message in messages:
+        message.seek(0, 2)
+        size += message.tell()
+        message.close()
+        count += 1
+    if _name == 'fetch-pool':
+        pool.close()
+    return count, size
+
+def runOwafetch(_port, _options):
+    """
+    Run owafetch (in a new process) with the properties for the fake server and the sink.
+    """
+    fd, fileName = tempfile.mkstemp('.properties')
+    try:
+        f = os.fdopen(fd, 'w')
+        f.write(PROPERTIES % dict(_options, port=_port))
+        f.close()
+        subprocess.check_call([sys.executable, os.path.join(BENCH_DIR, '..', 'owafetch.py'), '-s', fileName])
+    finally:
+        os.remove(fileName)
+    return 0, 0
+
+def startServer(_count, _options):
+    """
+    Start the fake server (in a new process) with _count messages. Returns the process and the port.
+    """
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fakeexchange.py'),
+                               '--port', '0', '--messages', str(_count),
+                               '--size', str(_options['size']), '--latency', str(_options['latency'])],
+                              stdout=subprocess.PIPE)
+    line = server.stdout.readline()
+    return server, int(line.split()[-1])
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser("usage: %prog [options] [number of messages ...]")
+    parser.add_option("-s", "--size", type="int", dest="size", default=5000, help="Size of the messages in bytes (default: 5000)")
+    parser.add_option("-l", "--latency", type="float", dest="latency", default=0.0, help="Delay of each response of the server in seconds (default: 0)")
+    parser.add_option("-c", "--concurrency", type="int", dest="concurrency", default=4, help="Number of connections of fetch-pool and owafetch (default: 4)")
+    parser.add_option("-p", "--page-size", type="int", dest="pageSize", default=1000, help="Page size of list-paged and owafetch (default: 1000)")
+    parser.add_option("-f", "--fetch-limit", type="int", dest="fetchLimit", default=0, help="Only fetch this number of messages in fetch and fetch-pool (default: all)")
+    parser.add_option("-b", "--benchmarks", dest="benchmarks", default=','.join(BENCHMARKS), help="Comma separated benchmarks to run (default: all)")
+    parser.add_option("--smtp-port", type="int", dest="smtpPort", default=0, help="Port of the SMTP sink (internal)")
+    parser.add_option("--run", dest="run", help="Run a single benchmark against the server on the given port (internal)")
+    parser.add_option("--port", type="int", dest="port", help="Port of the server (internal)")
+    (options, args) = parser.parse_args()
+    benchOptions = vars(options)
+
+    if options.run:
+        # run a single benchmark and report the results to the parent process
+        start = time.time()
+        count, size = runBenchmark(options.run, options.port, benchOptions)
+        elapsed = time.time() - start
+        who = (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)[options.run == 'owafetch']
+        # ru_maxrss is in kilobytes on Linux
+        print '%f %i %i %i' % (elapsed, count, size, resource.getrusage(who).ru_maxrss)
+        sys.exit(0)
+
+    counts = [int(a) for a in args] or [1000, 10000, 100000]
+    sink = smtpsink.start()
+    benchOptions['smtpPort'] = sink.port
+
+    print '%9s %-11s %9s %10s %9s %10s' % ('messages', 'benchmark', 'time (s)', 'messages/s', 'MB/s', 'peak RSS')
+    for count in counts:
+        for name in options.benchmarks.split(','):
+            # a new server for each benchmark, owafetch marks the messages as read
+            server, port = startServer(count, benchOptions)
+            try:
+                delivered = sink.messages
+                deliveredBytes = sink.bytes
+                out = subprocess.Popen([sys.executable, __file__, '--run', name, '--port', str(port),
+                                        '--concurrency', str(options.concurrency),
+                                        '--page-size', str(options.pageSize),
+                                        '--fetch-limit', str(options.fetchLimit),
+                                        '--smtp-port', str(sink.port)],
+                                       stdout=subprocess.PIPE).communicate()[0]
+                elapsed, found, size, maxrss = out.split()
+                elapsed = float(elapsed)
+                found = int(found)
+                size = int(size)
+                if name == 'owafetch':
+                    sink.waitFor(delivered + count)
+                    found = sink.messages - delivered
+                    size = sink.bytes - deliveredBytes
+            finally:
+                server.terminate()
+                server.wait()
+            print '%9i %-11s %9.2f %10.1f %9.2f %8.1f MB' % \
+                (count, name, elapsed, found / elapsed, size / elapsed / 1e6, int(maxrss) / 1024.0)
+            sys.stdout.flush()
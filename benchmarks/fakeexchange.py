@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+A local stand-in for a MS Exchange 2003 server with Outlook Web Access,
+to benchmark owalib and owafetch without a real server.
+
+Implements the requests used by owalib:
+ - POST to the form based authentication page (owaauth.dll), sets the session cookie
+ - GET /<exchange path>/, the root page with the <BASE href="..."> of the user
+ - PROPFIND of the root (inbox path) and of the inbox (message counts)
+ - SEARCH of the inbox, with the unread and creationdate conditions, row ranges
+   and the urn:schemas:mailheader: headers
+ - GET of a message (Translate: F)
+ - BPROPPATCH (mark as read) and BDELETE of messages in the inbox
+
+The messages are generated from their index, so large mailboxes take little memory.
+All requests except the authentication need the session cookie (else status 440).
+
+Usage: fakeexchange.py [options], see --help.
+Or start a FakeExchangeServer from another script (see start).
+"""
+
+import sys
+import re
+import time
+import random
+import threading
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape
+
+EXCHANGE_PATH = 'exchange'
+USER = 'user'
+FBA_PATH = '/exchweb/bin/auth/owaauth.dll'
+COOKIE = 'sessionid=fakeexchange'
+
+MULTISTATUS_START = '<?xml version="1.0"?><a:multistatus xmlns:b="urn:uuid:c2f41010-65b3-11d1-a29f-00aa00c14882/" ' \
+                    'xmlns:d="urn:schemas:httpmail:" xmlns:e="urn:schemas:mailheader:" xmlns:a="DAV:">'
+MULTISTATUS_END = '</a:multistatus>'
+
+MESSAGE_ITEM = '<a:response><a:href>%(href)s</a:href><a:propstat><a:status>HTTP/1.1 200 OK</a:status><a:prop>' \
+               '<d:fromemail>%(fromemail)s</d:fromemail><d:subject>%(subject)s</d:subject>' \
+               '<d:read b:dt="boolean">%(read)i</d:read>' \
+               '<a:creationdate b:dt="dateTime.tz">%(creationdate)s</a:creationdate>' \
+               '<a:getcontentlength b:dt="int">%(size)i</a:getcontentlength>' \
+               '<d:datereceived b:dt="dateTime.tz">%(creationdate)s</d:datereceived>%(headers)s' \
+               '</a:prop></a:propstat></a:response>'
+
+FILLER = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\r\n'
+
+class Mailbox(object):
+    """
+    The inbox of the fake server with _count generated messages. The sizes of the
+    messages are between _minSize and _maxSize bytes. The state is shared by all
+    requests, so access it with the lock.
+    """
+    def __init__(self, _count, _minSize = 5000, _maxSize = None, _unread = 1.0):
+        self.count = _count
+        self.minSize = _minSize
+        self.maxSize = max(_minSize, _maxSize or _minSize)
+        self.lock = threading.Lock()
+        r = random.Random(_count)
+        # read flags (1 is read) and deleted flags of the messages
+        self.read = bytearray([int(r.random() >= _unread) for i in xrange(_count)])
+        self.deleted = bytearray(_count)
+        self.modified = 0
+
+    def size(self, _index):
+        if self.maxSize == self.minSize:
+            return self.minSize
+        return random.Random(_index).randint(self.minSize, self.maxSize)
+
+    def name(self, _index):
+        return 'Message%07i.EML' % _index
+
+    def index(self, _name):
+        m = re.match(r'Message(\d+)\.EML$', _name)
+        if not m or int(m.group(1)) >= self.count:
+            return None
+        return int(m.group(1))
+
+    def creationdate(self, _index):
+        # one message per minute starting at 2009-01-01
+        t = time.gmtime(1230768000 + 60 * _index)
+        return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', t)
+
+    def sender(self, _index):
+        return 'sender%i@example.com' % (_index % 100)
+
+    def subject(self, _index):
+        return 'Subject of message %i' % _index
+
+    def headers(self, _index):
+        """
+        Returns the (lower case) names and values of the headers of the message.
+        """
+        return [('from', '<%s>' % self.sender(_index)), ('to', '<user@example.com>'),
+                ('subject', self.subject(_index)), ('message-id', '<%i@fakeexchange>' % _index),
+                ('date', self.creationdate(_index))]
+
+    def message(self, _index):
+        """
+        Returns the raw text of the message.
+        """
+        head = ''.join(['%s: %s\r\n' % (name.title(), value) for name, value in self.headers(_index)]) + '\r\n'
+        size = self.size(_index)
+        body = FILLER * (max(0, size - len(head)) // len(FILLER) + 1)
+        return head + body[:max(0, size - len(head))]
+
+    def visible(self):
+        return [i for i in xrange(self.count) if not self.deleted[i]]
+
+def listHeaders(_names, _headers):
+    """
+    Returns the XML of the requested headers of a message in a SEARCH response.
+    """
+    headers = dict(_headers)
+    return ''.join(['<e:%s>%s</e:%s>' % (name, escape(headers.get(name, '')), name) for name in _names])
+
+class FakeExchangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles the requests, see the module documentation.
+    """
+    protocol_version = 'HTTP/1.1'
+    # write each response at once
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def baseUrl(self):
+        return 'http://%s/%s/%s/' % (self.headers.get('Host', 'localhost'), EXCHANGE_PATH, USER)
+
+    def inboxUrl(self):
+        return self.baseUrl() + 'Inbox'
+
+    def readBody(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def respond(self, _status, _body = '', _headers = {}):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(_status)
+        self.send_header('Content-Length', str(len(_body)))
+        for name, value in _headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def authorized(self):
+        """
+        Check the session cookie, responds with 440 (Login Timeout) if it is not valid.
+        """
+        cookies = [c.strip() for c in (self.headers.get('Cookie') or '').split(';')]
+        if COOKIE in cookies:
+            return True
+        self.respond(440, 'Login Timeout')
+        return False
+
+    def do_POST(self):
+        self.readBody()
+        if self.path != FBA_PATH:
+            self.respond(404)
+            return
+        self.respond(302, '', {'Set-Cookie': COOKIE + '; path=/', 'Location': '/%s/' % EXCHANGE_PATH})
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        if self.path.strip('/') == EXCHANGE_PATH:
+            self.respond(200, '<html><head><BASE href="%s"></head></html>' % self.baseUrl())
+            return
+        mailbox = self.server.mailbox
+        i = mailbox.index(self.path.split('/')[-1])
+        if i is None or mailbox.deleted[i]:
+            self.respond(404)
+            return
+        self.respond(200, mailbox.message(i), {'Content-Type': 'message/rfc822'})
+
+    def do_PROPFIND(self):
+        self.readBody()
+        if not self.authorized():
+            return
+        mailbox = self.server.mailbox
+        if self.path.rstrip('/').endswith('/Inbox'):
+            mailbox.lock.acquire()
+            try:
+                visible = mailbox.visible()
+                unread = len([i for i in visible if not mailbox.read[i]])
+                modified = mailbox.modified
+            finally:
+                mailbox.lock.release()
+            prop = '<d:unreadcount>%i</d:unreadcount><a:visiblecount>%i</a:visiblecount>' \
+                   '<a:getlastmodified>2009-01-01T00:00:00.%03iZ</a:getlastmodified>' % \
+                   (unread, len(visible), modified % 1000)
+            href = self.inboxUrl()
+        else:
+            prop = '<d:inbox>%s</d:inbox>' % self.inboxUrl()
+            href = self.baseUrl()
+        self.respond(207, MULTISTATUS_START + '<a:response><a:href>%s</a:href><a:propstat>'
+                     '<a:status>HTTP/1.1 200 OK</a:status><a:prop>%s</a:prop></a:propstat>'
+                     '</a:response>' % (href, prop) + MULTISTATUS_END)
+
+    def do_SEARCH(self):
+        query = self.readBody()
+        if not self.authorized():
+            return
+        mailbox = self.server.mailbox
+        unreadOnly = re.search(r'"urn:schemas:httpmail:read"\s*=\s*False', query) is not None
+        since = re.search(r'"DAV:creationdate"\s*&gt;=\s*CAST\("([^"]+)"', query)
+        headerNames = re.findall(r'"urn:schemas:mailheader:([\w-]+)"', query)
+
+        mailbox.lock.acquire()
+        try:
+            rows = [i for i in mailbox.visible() if not (unreadOnly and mailbox.read[i])]
+            if since:
+                rows = [i for i in rows if mailbox.creationdate(i) >= since.group(1)]
+            read = [mailbox.read[i] for i in rows]
+        finally:
+            mailbox.lock.release()
+
+        status = 207
+        headers = {}
+        first = 0
+        rowRange = re.match(r'rows=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if rowRange:
+            first = int(rowRange.group(1))
+            last = len(rows) - 1
+            if rowRange.group(2):
+                last = min(last, int(rowRange.group(2)))
+            if first > 0 and first >= len(rows):
+                self.respond(416)
+                return
+            headers['Content-Range'] = 'rows %i-%i; total=%i' % (first, last, len(rows))
+            status = 206
+            rows = rows[first:last + 1]
+            read = read[first:last + 1]
+
+        inbox = self.inboxUrl()
+        items = [MESSAGE_ITEM % {'href': '%s/%s' % (inbox, mailbox.name(i)),
+                                 'fromemail': mailbox.sender(i), 'subject': mailbox.subject(i),
+                                 'read': r, 'creationdate': mailbox.creationdate(i),
+                                 'size': mailbox.size(i),
+                                 'headers': listHeaders(headerNames, mailbox.headers(i))}
+                 for i, r in zip(rows, read)]
+        self.respond(status, MULTISTATUS_START + ''.join(items) + MULTISTATUS_END, headers)
+
+    def batch(self, _action):
+        """
+        Apply _action(index) to the messages in the body of a BPROPPATCH or BDELETE request.
+        """
+        body = self.readBody()
+        if not self.authorized():
+            return
+        mailbox = self.server.mailbox
+        inbox = self.inboxUrl()
+        items = []
+        mailbox.lock.acquire()
+        try:
+            for name in re.findall(r'<D:href>([^<]*)</D:href>', body):
+                i = mailbox.index(name.split('/')[-1])
+                if i is None or mailbox.deleted[i]:
+                    status = '404 Not Found'
+                else:
+                    _action(i)
+                    status = '200 OK'
+                items.append('<a:response><a:href>%s/%s</a:href><a:status>HTTP/1.1 %s</a:status>'
+                             '</a:response>' % (inbox, name, status))
+            mailbox.modified += 1
+        finally:
+            mailbox.lock.release()
+        self.respond(207, MULTISTATUS_START + ''.join(items) + MULTISTATUS_END)
+
+    def do_BPROPPATCH(self):
+        mailbox = self.server.mailbox
+        self.batch(lambda i: mailbox.read.__setitem__(i, 1))
+
+    def do_BDELETE(self):
+        mailbox = self.server.mailbox
+        self.batch(lambda i: mailbox.deleted.__setitem__(i, 1))
+
+class FakeExchangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    The fake server with the _mailbox, each response is delayed by _latency seconds.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 64
+
+    def __init__(self, _address, _mailbox, _latency = 0.0, _verbose = False):
+        BaseHTTPServer.HTTPServer.__init__(self, _address, FakeExchangeHandler)
+        self.mailbox = _mailbox
+        self.latency = _latency
+        self.verbose = _verbose
+
+def start(_mailbox, _port = 0, _latency = 0.0):
+    """
+    Start a fake server in a (daemon) thread. Returns the server,
+    use server.server_address[1] for the port.
+    """
+    server = FakeExchangeServer(('localhost', _port), _mailbox, _latency)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-p", "--port", type="int", dest="Port", default=8080, help="Port to listen on (default: 8080, 0 for any free port)")
+    parser.add_option("-n", "--messages", type="int", dest="Messages", default=1000, help="Number of messages in the inbox (default: 1000)")
+    parser.add_option("-s", "--size", type="int", dest="Size", default=5000, help="Size of the messages in bytes (default: 5000)")
+    parser.add_option("--max-size", type="int", dest="MaxSize", help="If given the sizes of the messages are between --size and --max-size bytes")
+    parser.add_option("-u", "--unread", type="float", dest="Unread", default=1.0, help="Fraction of the messages which is unread (default: 1.0)")
+    parser.add_option("-l", "--latency", type="float", dest="Latency", default=0.0, help="Delay of each response in seconds (default: 0)")
+    parser.add_option("-v", "--verbose", action="store_true", dest="Verbose", help="Log the requests")
+    (options, args) = parser.parse_args()
+
+    mailbox = Mailbox(options.Messages, options.Size, options.MaxSize, options.Unread)
+    server = FakeExchangeServer(('localhost', options.Port), mailbox, options.Latency, options.Verbose)
+    # the port is printed first, for scripts which start the server with --port 0
+    print 'Listening on port %i' % server.server_address[1]
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+A local SMTP server which accepts and discards all messages, to benchmark
+the delivery of owafetch. Counts the received messages and bytes.
+
+Usage: smtpsink.py [port (default 8025)]
+Or start a SMTPSink from another script (see start).
+"""
+
+import sys
+import time
+import smtpd
+import asyncore
+import threading
+
+class SMTPSink(smtpd.SMTPServer):
+    """
+    SMTP server which counts and discards the messages.
+    """
+    def __init__(self, _port = 0):
+        smtpd.SMTPServer.__init__(self, ('localhost', _port), None)
+        self.port = self.socket.getsockname()[1]
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+        self.last = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.lock.acquire()
+        try:
+            self.messages += 1
+            self.bytes += len(data)
+            self.last = time.time()
+        finally:
+            self.lock.release()
+
+    def waitFor(self, _messages, _timeout = 10.0):
+        """
+        Wait until _messages have been received. Returns False on a timeout.
+        """
+        end = time.time() + _timeout
+        while self.messages < _messages and time.time() < end:
+            time.sleep(0.01)
+        return self.messages >= _messages
+
+def start(_port = 0):
+    """
+    Start a sink in a (daemon) thread. Returns the sink, use sink.port for the port.
+    """
+    sink = SMTPSink(_port)
+    t = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+    t.setDaemon(True)
+    t.start()
+    return sink
+
+if __name__ == "__main__":
+    port = 8025
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    sink = SMTPSink(port)
+    print 'Listening on port %i' % sink.port
+    sys.stdout.flush()
+    try:
+        asyncore.loop()
+    except KeyboardInterrupt:
+        print '%i message(s), %i bytes received' % (sink.messages, sink.bytes)
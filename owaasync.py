@@ -0,0 +1,747 @@
+#!/usr/bin/env python
+# ----------------------------------------------------------------------------
+# Copyright (c) 2009 Pieter Kitslaar
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions 
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright 
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+# ----------------------------------------------------------------------------
+
+"""
+Asynchronous counterpart of the OWAConnection classes in owalib.py.
+
+A single thread can run the requests of many mailboxes and many concurrent 
+downloads. The requests of an AsyncOWAConnection are spread over a small set
+of keep-alive connections which are driven by asyncore; all connections in 
+the same socket map are handled by the same loop.
+
+The methods of AsyncOWAConnection are coroutines: generators which yield the
+requests they wait for and which are run by run (or as a Task). For example:
+
+    def fetchInbox(owa):
+        yield owa.doFBA(username, password, 'exchange', '/exchweb/bin/auth/owaauth.dll')
+        rootPath = yield owa.getRootPath('exchange')
+        inboxPath = yield owa.getInboxPath(rootPath)
+        messages = yield owa.getListMessages(inboxPath)
+        # download all messages at the same time
+        texts = yield [owa.getMessage(m['href']) for m in messages]
+        raise Return(texts)
+
+    owa = AsyncOWAConnection('xxx.dddddd.com', True)
+    texts, = run([fetchInbox(owa)])
+
+A coroutine can yield a request, another coroutine, or a list of those to wait
+for all of them. The value of the yield is the result (a list of results for a
+list), errors are raised at the yield. Because a generator can't return a value
+the result of a coroutine is given by raising Return(value).
+"""
+
+import asyncore
+import socket
+import errno
+import types
+import time
+import sys
+import re
+import httplib
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+import owalib
+
+# seconds without any activity on a connection before its request fails
+DEFAULT_TIMEOUT = 60.0
+
+class Return(Exception):
+    """
+    Raise Return(value) to return a value from a coroutine.
+    """
+    def __init__(self, _value = None):
+        Exception.__init__(self)
+        self.value = _value
+
+class Future(object):
+    """
+    The result of an operation which completes later.
+    Callbacks added with addCallback are called with the future when it completes.
+    """
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.exc_info = None
+        self.callbacks = []
+
+    def addCallback(self, _callback):
+        if self.done:
+            _callback(self)
+        else:
+            self.callbacks.append(_callback)
+
+    def setResult(self, _result, _exc_info = None):
+        self.result = _result
+        self.exc_info = _exc_info
+        self.done = True
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def setError(self, _exc_info):
+        self.setResult(None, _exc_info)
+
+    def get(self):
+        """
+        Returns the result, or raises the error of the operation.
+        """
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class Task(Future):
+    """
+    Runs a coroutine (see the module documentation). 
+    The result of the task is the value returned by the coroutine.
+    """
+    def __init__(self, _coroutine):
+        Future.__init__(self)
+        self.coroutine = _coroutine
+        self.step(None, None)
+
+    def step(self, _value, _exc_info):
+        try:
+            if _exc_info is not None:
+                waitFor = self.coroutine.throw(*_exc_info)
+            else:
+                waitFor = self.coroutine.send(_value)
+        except Return, r:
+            self.setResult(r.value)
+        except StopIteration:
+            self.setResult(None)
+        except Exception:
+            self.setError(sys.exc_info())
+        else:
+            self.wait(waitFor)
+
+    def wait(self, _waitFor):
+        if isinstance(_waitFor, list):
+            futures = [toFuture(f) for f in _waitFor]
+            gathered = Gather(futures)
+        else:
+            gathered = toFuture(_waitFor)
+        gathered.addCallback(self.resume)
+
+    def resume(self, _future):
+        if _future.exc_info is not None:
+            self.step(None, _future.exc_info)
+        else:
+            self.step(_future.result, None)
+
+class Gather(Future):
+    """
+    Completes with the list of results when all _futures are completed, 
+    or with the first error.
+    """
+    def __init__(self, _futures):
+        Future.__init__(self)
+        self.futures = _futures
+        self.pending = len(_futures)
+        if not _futures:
+            self.setResult([])
+        for f in _futures:
+            f.addCallback(self.completed)
+
+    def completed(self, _future):
+        if self.done:
+            return
+        if _future.exc_info is not None:
+            self.setError(_future.exc_info)
+            return
+        self.pending -= 1
+        if self.pending == 0:
+            self.setResult([f.result for f in self.futures])
+
+def toFuture(_waitFor):
+    """
+    Returns the future for something a coroutine waits for (a future or a coroutine).
+    """
+    if isinstance(_waitFor, Future):
+        return _waitFor
+    if isinstance(_waitFor, types.GeneratorType):
+        return Task(_waitFor)
+    raise TypeError("A coroutine can't wait for %r" % (_waitFor,))
+
+class AsyncResponse(object):
+    """
+    The response of the server to an AsyncRequest. 
+    Offers the parts of the httplib.HTTPResponse interface used by owalib.
+    """
+    def __init__(self, _status, _reason, _headers, _body):
+        self.status = _status
+        self.reason = _reason
+        # list of (lower case name, value) tuples
+        self.headers = _headers
+        self.body = StringIO.StringIO(_body)
+
+    def getheader(self, _name, _default = None):
+        values = [v for n, v in self.headers if n == _name.lower()]
+        if not values:
+            return _default
+        return ', '.join(values)
+
+    def getheaders(self):
+        return list(self.headers)
+
+    def read(self, _size = -1):
+        return self.body.read(_size)
+
+class AsyncRequest(Future):
+    """
+    A HTTP request. The result is an AsyncResponse.
+    """
+    def __init__(self, _method, _url, _body, _headers):
+        Future.__init__(self)
+        self.method = _method
+        self.url = _url
+        self.body = _body or ''
+        self.headers = _headers
+        # number of times the request is sent (it is sent again once if a 
+        # keep-alive connection turns out to be closed by the server)
+        self.attempts = 0
+
+    def data(self, _host):
+        lines = ['%s %s HTTP/1.1' % (self.method, self.url),
+                 'Host: %s' % _host,
+                 'Accept-Encoding: identity',
+                 'Content-Length: %i' % len(self.body)]
+        for name, value in self.headers.items():
+            lines.append('%s: %s' % (name, value))
+        return '\r\n'.join(lines) + '\r\n\r\n' + self.body
+
+class HTTPChannel(asyncore.dispatcher):
+    """
+    A keep-alive connection to the server of an AsyncOWAConnection.
+    Handles one request at a time.
+    """
+    def __init__(self, _client):
+        asyncore.dispatcher.__init__(self, map=_client.map)
+        self.client = _client
+        self.request = None
+        self.reused = False
+        self.opened = False
+        self.handshaking = False
+        self.outbuf = ''
+        self.lastActivity = time.time()
+        self.reset()
+
+    def reset(self):
+        # state of the response parser
+        self.inbuf = ''
+        self.state = 'status'
+        self.status = None
+        self.reason = None
+        self.responseHeaders = []
+        self.bodyParts = []
+        self.remaining = None
+        self.keepAlive = True
+        self.received = False
+
+    def start(self, _request):
+        """
+        Send the _request, opening the connection if needed.
+        """
+        self.request = _request
+        _request.attempts += 1
+        self.reset()
+        self.outbuf = _request.data(self.client.netloc)
+        self.lastActivity = time.time()
+        try:
+            if self.socket is None:
+                self.reused = False
+                self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.connect((self.client.host, self.client.port))
+            else:
+                self.reused = True
+                self.sendData()
+        except socket.error:
+            self.fail(sys.exc_info())
+
+    # asyncore interface
+
+    def readable(self):
+        return self.socket is not None
+
+    def writable(self):
+        return not self.opened or self.handshaking or len(self.outbuf) > 0
+
+    def handle_connect(self):
+        self.opened = True
+        if self.client.secure:
+            import ssl
+            # verify the certificate and the host name (sent with SNI) of the server
+            context = ssl.create_default_context()
+            sslSocket = context.wrap_socket(self.socket, server_hostname=self.client.host, 
+                                            do_handshake_on_connect=False)
+            self.del_channel()
+            self.set_socket(sslSocket)
+            self.handshaking = True
+            self.doHandshake()
+        else:
+            self.sendData()
+
+    def handle_write(self):
+        if self.handshaking:
+            self.doHandshake()
+        else:
+            self.sendData()
+
+    def handle_read(self):
+        if self.handshaking:
+            self.doHandshake()
+            return
+        while True:
+            try:
+                data = self.socket.recv(owalib.CHUNK_SIZE)
+            except socket.error, e:
+                if self.wouldBlock(e):
+                    return
+                self.fail(sys.exc_info())
+                return
+            if not data:
+                self.connectionClosed()
+                return
+            self.lastActivity = time.time()
+            self.received = True
+            self.inbuf += data
+            self.parse()
+            if self.socket is None:
+                return
+
+    def handle_close(self):
+        self.connectionClosed()
+
+    def handle_error(self):
+        self.fail(sys.exc_info())
+
+    # helpers
+
+    def wouldBlock(self, _error):
+        import ssl
+        if isinstance(_error, ssl.SSLError):
+            return _error.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+        return _error.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN)
+
+    def doHandshake(self):
+        try:
+            self.socket.do_handshake()
+        except socket.error, e:
+            if self.wouldBlock(e):
+                return
+            raise
+        self.handshaking = False
+        self.sendData()
+
+    def sendData(self):
+        while self.outbuf:
+            try:
+                sent = self.socket.send(self.outbuf[:owalib.CHUNK_SIZE])
+            except socket.error, e:
+                if self.wouldBlock(e):
+                    return
+                if self.reused and e.args[0] in (errno.EPIPE, errno.ECONNRESET):
+                    # the server closed the keep-alive connection
+                    self.connectionClosed()
+                    return
+                raise
+            self.outbuf = self.outbuf[sent:]
+            self.lastActivity = time.time()
+
+    def connectionClosed(self):
+        if self.state == 'close' and self.request is not None:
+            # the body of the response ends when the connection is closed
+            self.complete()
+            return
+        request = self.request
+        self.closeSocket()
+        if request is None:
+            return
+        self.request = None
+        if self.reused and not self.received and request.attempts < 2:
+            # the keep-alive connection was closed by the server, send the request again
+            self.client.submit(request)
+        else:
+            try:
+                raise httplib.BadStatusLine('connection closed')
+            except httplib.BadStatusLine:
+                request.setError(sys.exc_info())
+        self.client.channelClosed(self)
+
+    def fail(self, _exc_info):
+        """
+        The request failed, close the connection.
+        """
+        request = self.request
+        self.request = None
+        self.closeSocket()
+        if request is not None:
+            request.setError(_exc_info)
+        self.client.channelClosed(self)
+
+    def closeSocket(self):
+        if self.socket is not None:
+            self.close()
+            self.socket = None
+        self.opened = False
+        self.handshaking = False
+        self.outbuf = ''
+
+    def checkTimeout(self, _now):
+        if self.request is not None and _now - self.lastActivity > self.client.timeout:
+            try:
+                raise socket.timeout('No response within %i seconds' % self.client.timeout)
+            except socket.timeout:
+                self.fail(sys.exc_info())
+
+    def parse(self):
+        """
+        Parse the received data of the response.
+        """
+        while True:
+            if self.state == 'status':
+                end = self.inbuf.find('\r\n\r\n')
+                if end < 0:
+                    return
+                head = self.inbuf[:end].split('\r\n')
+                self.inbuf = self.inbuf[end + 4:]
+                self.parseHead(head)
+            elif self.state == 'length':
+                take = self.inbuf[:self.remaining]
+                self.inbuf = self.inbuf[len(take):]
+                self.bodyParts.append(take)
+                self.remaining -= len(take)
+                if self.remaining > 0:
+                    return
+                self.complete()
+                return
+            elif self.state == 'chunk':
+                end = self.inbuf.find('\r\n')
+                if end < 0:
+                    return
+                size = int(self.inbuf[:end].split(';')[0], 16)
+                self.inbuf = self.inbuf[end + 2:]
+                if size == 0:
+                    self.state = 'trailer'
+                else:
+                    self.state = 'chunkdata'
+                    self.remaining = size
+            elif self.state == 'chunkdata':
+                if len(self.inbuf) < self.remaining + 2:
+                    return
+                self.bodyParts.append(self.inbuf[:self.remaining])
+                self.inbuf = self.inbuf[self.remaining + 2:]
+                self.state = 'chunk'
+            elif self.state == 'trailer':
+                end = self.inbuf.find('\r\n')
+                if end < 0:
+                    return
+                line = self.inbuf[:end]
+                self.inbuf = self.inbuf[end + 2:]
+                if not line:
+                    self.complete()
+                    return
+            elif self.state == 'close':
+                self.bodyParts.append(self.inbuf)
+                self.inbuf = ''
+                return
+
+    def parseHead(self, _lines):
+        version, status, reason = (_lines[0].split(None, 2) + ['', ''])[:3]
+        if not version.startswith('HTTP/'):
+            raise httplib.BadStatusLine(_lines[0])
+        self.status = int(status)
+        self.reason = reason
+        headers = []
+        for line in _lines[1:]:
+            if line[:1] in ' \t' and headers:
+                # continuation line
+                name, value = headers[-1]
+                headers[-1] = (name, value + ' ' + line.strip())
+                continue
+            name, sep, value = line.partition(':')
+            headers.append( (name.strip().lower(), value.strip()) )
+        self.responseHeaders = headers
+
+        if self.status == 100:
+            # 100 Continue, the real response follows
+            self.responseHeaders = []
+            return
+
+        connection = [v.lower() for n, v in headers if n == 'connection']
+        self.keepAlive = ('close' not in connection) and \
+                         (version != 'HTTP/1.0' or 'keep-alive' in connection)
+        encoding = [v.lower() for n, v in headers if n == 'transfer-encoding']
+        length = [v for n, v in headers if n == 'content-length']
+        if self.request.method == 'HEAD' or self.status in (204, 304):
+            self.state = 'length'
+            self.remaining = 0
+        elif encoding and encoding[-1] == 'chunked':
+            self.state = 'chunk'
+        elif length:
+            self.state = 'length'
+            self.remaining = int(length[0])
+        else:
+            self.state = 'close'
+            self.keepAlive = False
+
+    def complete(self):
+        """
+        The response is complete, hand it to the request and take the next request.
+        """
+        request = self.request
+        self.request = None
+        response = AsyncResponse(self.status, self.reason, self.responseHeaders, 
+                                 ''.join(self.bodyParts))
+        if not self.keepAlive:
+            self.closeSocket()
+        self.reset()
+        self.client.channelIdle(self)
+        request.setResult(response)
+
+class AsyncOWAConnection(object):
+    """
+    Asynchronous connection to a Outlook Web Access page using WebDAV.
+    The requests are sent over at most _size keep-alive connections, the 
+    connections are handled by the asyncore loop of the socket _map (see run).
+    
+    The methods return coroutines (see the module documentation) with the 
+    same results as the methods of the owalib OWAConnection classes.
+    """
+    def __init__(self, _host, _secure = False, _size = owalib.DEFAULT_POOL_SIZE, 
+                 _map = None, _timeout = DEFAULT_TIMEOUT):
+        self.secure = _secure
+        self.port = (httplib.HTTP_PORT, httplib.HTTPS_PORT)[_secure]
+        self.host = _host
+        host, sep, port = _host.rpartition(':')
+        if sep and port.isdigit():
+            self.host = host
+            self.port = int(port)
+        self.netloc = _host
+        self.size = _size
+        if _map is None:
+            _map = asyncore.socket_map
+        self.map = _map
+        self.timeout = _timeout
+        self.channels = []
+        self.idle = []
+        self.pending = []
+        self.authentication_header = None
+        # see owalib getMessage
+        self.messageCache = None
+
+    # connection management
+
+    def submit(self, _request):
+        """
+        Send the _request over an idle connection, a new connection or queue it.
+        """
+        if self.idle:
+            self.idle.pop().start(_request)
+        elif len(self.channels) < self.size:
+            channel = HTTPChannel(self)
+            self.channels.append(channel)
+            channel.start(_request)
+        else:
+            self.pending.append(_request)
+
+    def channelIdle(self, _channel):
+        if self.pending:
+            _channel.start(self.pending.pop(0))
+        else:
+            self.idle.append(_channel)
+
+    def channelClosed(self, _channel):
+        if _channel in self.idle:
+            self.idle.remove(_channel)
+        if _channel in self.channels:
+            self.channels.remove(_channel)
+        if self.pending:
+            self.submit(self.pending.pop(0))
+
+    def checkTimeouts(self, _now):
+        for channel in list(self.channels):
+            channel.checkTimeout(_now)
+
+    def close(self):
+        """
+        Close all connections.
+        """
+        for channel in list(self.channels):
+            channel.closeSocket()
+        self.channels = []
+        self.idle = []
+
+    def do_request(self, method, url, body=None, extra_hdrs={}):
+        """
+        Make a request to the server. Returns an AsyncRequest.
+        """
+        request_header = extra_hdrs.copy()
+        if self.authentication_header != None:
+            request_header.update(self.authentication_header)
+        request = AsyncRequest(method, url, body, request_header)
+        self.submit(request)
+        return request
+
+    def checkStatus(self, _resp, _expected, _pathError = True):
+        """
+        Check the status of the response (see owalib checkStatus).
+        """
+        owalib.checkStatus(_resp, _expected, _pathError)
+
+    # coroutines
+
+    def doFBA(self, _username, _password, _exchangePath, _fbaPath):
+        """
+        Try to authenticate with form based authentication (FBA).
+        Stores the authentication cookie in the authentication_header.
+        """
+        protocol = ('http://', 'https://')[self.secure]
+
+        # define the body of the request setting the username and password
+        owabody = ''
+        owabody += 'destination=' + protocol + self.netloc + '/' + _exchangePath + '/'
+        owabody += '&username=' + _username
+        owabody += '&password=' + _password
+
+        owaheaders = {'Content-Type': 'application/x-www-form-urlencoded',
+        'User-Agent': 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.2; .NET CLR 1.1.4322)'}
+
+        resp = yield self.do_request('POST', _fbaPath, owabody, owaheaders)
+        resp.read()
+
+        # get the cookies set by the server
+        cookie_string = ''
+        for name, value in resp.getheaders():
+            if name == 'set-cookie':
+                cookie_string += value.split(';')[0].strip() + ';'
+        if not cookie_string:
+            raise owalib.SessionError("Authentication failed (status = %s). Exiting!" % resp.status)
+
+        self.authentication_header = {'Cookie': cookie_string}
+
+    def getRootPath(self, _pRootPath):
+        """
+        Return the user's root path on the server based on the given exchange path.
+        """
+        resp = yield self.do_request('GET', "/" + _pRootPath + "/")
+        self.checkStatus(resp, (200,))
+
+        m = re.search('<BASE href="([^"]+)">', resp.read())
+        if not m:
+            raise ValueError("Could not find <BASE href=\"..\"> tag. Exiting!")
+        raise Return(m.group(1))
+
+    def getInboxPath(self, _rootPath):
+        """
+        Get the inbox path based on the given root path.
+        """
+        hrd = {'Depth': '1', 'Content-Type': owalib.XML_CONTENT_TYPE}
+        resp = yield self.do_request('PROPFIND', _rootPath, owalib.getInboxMsg(), hrd)
+        self.checkStatus(resp, (207,))
+
+        inbox = owalib.xmlName(owalib.HTTPMAIL_NS, 'inbox')
+        for href, codes, props in owalib.iterMultiStatus(resp):
+            if inbox in props:
+                raise Return(props[inbox])
+
+        raise ValueError("Could not find inbox path. Exiting!")
+
+    def getListMessages(self, _inboxPath, _all = False, _since = None, _headers = (), _query = None):
+        """
+        Returns the url, subject and fromemail of the unread (or all) messages in the _inboxPath.
+        Returns a list of MessageInfo records, see owalib getListMessages.
+        """
+        hrd = {'Depth': '1', 'Content-Type': owalib.XML_CONTENT_TYPE}
+        resp = yield self.do_request('SEARCH', _inboxPath, owalib.getListMailMsg(_all, _since, _headers, _query), hrd)
+        self.checkStatus(resp, (207,))
+        raise Return(list(owalib.iterParseMessages(resp, _headers, _query)))
+
+    def getMessage(self, _messagePath, _version = None):
+        """
+        Return the raw text of the message (from the messageCache if it is cached).
+        """
+        cache = self.messageCache
+        if cache is not None:
+            cached = cache.get(_messagePath, _version)
+            if cached is not None:
+                try:
+                    raise Return(cached.read())
+                finally:
+                    cached.close()
+
+        hdr = {'Translate': 'F'}
+        resp = yield self.do_request('GET', _messagePath, "", hdr)
+        self.checkStatus(resp, (200,), False)
+        text = resp.read()
+        if cache is not None:
+            cache.put(_messagePath, _version, text)
+        raise Return(text)
+
+    def markAsRead(self, _inboxPath, _messagePath):
+        """
+        Mark a message as read. Requires the path to the "inbox" and the full path to the message.
+        """
+        hdr = {'Content-type': owalib.XML_CONTENT_TYPE}
+        resp = yield self.do_request('BPROPPATCH', _inboxPath + '/', 
+                                     owalib.getMarkAsReadMsg(_messagePath), hdr)
+        raise Return(resp.status == 207)
+
+    def deleteMessage(self, _inboxPath, _messagePath):
+        """
+        Delete a message on the server. 
+        N.B. Does not move the message to "Trash" really deletes it!
+
+        Requires the path to the "inbox" and the full path to the message.
+        """
+        hdr = {'Content-type': owalib.XML_CONTENT_TYPE}
+        resp = yield self.do_request('BDELETE', _inboxPath + '/', 
+                                     owalib.getDeleteMsg(_messagePath), hdr)
+        raise Return(resp.status == 207)
+
+def run(_coroutines, _map = None):
+    """
+    Run the coroutines (at the same time) until all are completed. 
+    Returns the list of their results, the first error is raised.
+    """
+    if _map is None:
+        _map = asyncore.socket_map
+    tasks = [toFuture(c) for c in _coroutines]
+    while not all([t.done for t in tasks]):
+        if not _map:
+            raise ValueError("Coroutines are waiting without open connections. Exiting!")
+        asyncore.loop(timeout=1.0, map=_map, count=1)
+        now = time.time()
+        clients = set([channel.client for channel in _map.values() 
+                       if isinstance(channel, HTTPChannel)])
+        for client in clients:
+            client.checkTimeouts(now)
+    return [t.get() for t in tasks]
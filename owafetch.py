@@ -38,46 +38,851 @@ Uses the OWAConnection class in the owalib.py file.
 Author: Pieter Kitslaar (c) 2009
 """
 
+import os
 import sys
+import re
+import errno
+import time
+import signal
+import json
+import hashlib
 import logging
+import itertools
+import collections
+import math
+import threading
+import heapq
+import Queue
 import owalib
-import smtplib
-import subprocess
 
-def sendMail(_fromAddress, _message, _prop_dict):
+def sendStreamSMTP(_smtp, _fromAddress, _toAddress, _file):
     """
-    Sends an email.
+    Like smtplib.SMTP.sendmail, but reads the message line by line from the 
+    file-like object _file so the message is never kept in memory as a whole.
     """
-    # get the destination address
-    dstAddress = _prop_dict['DestinationAddress'] 
-    procmail = _prop_dict.get('ProcMail', 'false').lower() == 'true'
+    import smtplib
+    _smtp.ehlo_or_helo_if_needed()
+    code, resp = _smtp.mail(_fromAddress)
+    if code != 250:
+        _smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, _fromAddress)
+    code, resp = _smtp.rcpt(_toAddress)
+    if code not in (250, 251):
+        _smtp.rset()
+        raise smtplib.SMTPRecipientsRefused({_toAddress: (code, resp)})
+    code, resp = _smtp.docmd('data')
+    if code != 354:
+        _smtp.rset()
+        raise smtplib.SMTPDataError(code, resp)
 
-    if (procmail):
-        # send via procmail like utility (DestinationAddress contains path to utility)
-        pmp = subprocess.Popen(dstAddress, stdin=subprocess.PIPE)
-        pmp.communicate(_message)
-    else:
-        # send via SMTP
+    # send the lines with CRLF line endings and leading dots escaped,
+    # collecting them in buffers of about CHUNK_SIZE bytes
+    buf = []
+    size = 0
+    for line in _file:
+        line = line.rstrip('\r\n')
+        if line.startswith('.'):
+            line = '.' + line
+        buf.append(line)
+        size += len(line) + 2
+        if size >= owalib.CHUNK_SIZE:
+            buf.append('')
+            _smtp.send('\r\n'.join(buf))
+            buf = []
+            size = 0
+    buf.append('.\r\n')
+    _smtp.send('\r\n'.join(buf))
+
+    code, resp = _smtp.getreply()
+    if code != 250:
+        _smtp.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+# lines of a message which are escaped with a '>' in a mbox file (mboxrd)
+MBOX_FROM_LINE = re.compile(r'^>*From ')
+
+def writeLocalMessage(_file, _message, _escapeFrom = False):
+    """
+    Write the _message (a string or a file-like object which is read line by line) 
+    to the _file with LF line endings, as used in mbox files and Maildirs.
+    The lines are collected in buffers of about CHUNK_SIZE bytes.
+    If _escapeFrom == True the 'From ' lines are escaped (see MBOX_FROM_LINE).
+    """
+    if isinstance(_message, basestring):
+        _message = _message.splitlines(True)
+    buf = []
+    size = 0
+    for line in _message:
+        line = line.rstrip('\r\n')
+        if _escapeFrom and MBOX_FROM_LINE.match(line):
+            line = '>' + line
+        buf.append(line)
+        size += len(line) + 1
+        if size >= owalib.CHUNK_SIZE:
+            buf.append('')
+            _file.write('\n'.join(buf))
+            buf = []
+            size = 0
+    buf.append('')
+    _file.write('\n'.join(buf))
+
+# seconds to wait for the lock of a mbox file
+MBOX_LOCK_TIMEOUT = 30
+# seconds after which the dot-lock file of a mbox file is considered stale
+MBOX_STALE_LOCK = 300
+
+class MboxWriter(object):
+    """
+    Appends messages to a mbox file (in the mboxrd format, see MBOX_FROM_LINE).
+    The file is locked with a dot-lock file and with fcntl (if available) only 
+    while a message is written, so other programs can use the file in between. 
+    Each message is flushed when written, but the messages are only forced to 
+    disk (together) by close.
+    """
+    def __init__(self, _fileName):
+        self.fileName = _fileName
+        self.file = open(_fileName, 'ab')
+
+    def lock(self):
+        """
+        Create the dot-lock file and lock the file with fcntl, waiting at most MBOX_LOCK_TIMEOUT seconds.
+        If the directory isn't writable (like some mail spools) only fcntl is used.
+        """
+        self.lockName = self.fileName + '.lock'
+        end = time.time() + MBOX_LOCK_TIMEOUT
+        while True:
+            try:
+                os.close(os.open(self.lockName, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600))
+                break
+            except OSError, e:
+                if e.errno in (errno.EACCES, errno.EPERM, errno.EROFS):
+                    self.lockName = None
+                    break
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if time.time() - os.path.getmtime(self.lockName) > MBOX_STALE_LOCK:
+                    os.remove(self.lockName)
+                    continue
+            except OSError:
+                # removed by its owner
+                continue
+            if time.time() > end:
+                raise ValueError("Could not lock %s (%s exists). Exiting!" % (self.fileName, self.lockName))
+            time.sleep(0.1)
+
+        try:
+            import fcntl
+        except ImportError:
+            return
+        try:
+            while True:
+                try:
+                    fcntl.lockf(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError, e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                if time.time() > end:
+                    raise ValueError("Could not lock %s. Exiting!" % self.fileName)
+                time.sleep(0.1)
+        except:
+            if self.lockName is not None:
+                os.remove(self.lockName)
+            raise
+
+    def unlock(self):
+        """
+        Remove the locks of lock.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            pass
+        else:
+            fcntl.lockf(self.file, fcntl.LOCK_UN)
+        if self.lockName is not None:
+            os.remove(self.lockName)
+
+    def add(self, _fromAddress, _message):
+        """
+        Append the _message (a string or a file-like object), with a From line with the _fromAddress.
+        A message which could not be written completely is removed from the file again.
+        """
+        self.lock()
+        try:
+            self.file.seek(0, 2)
+            start = self.file.tell()
+            try:
+                sender = re.sub(r'\s', '', _fromAddress or '') or 'MAILER-DAEMON'
+                self.file.write('From %s %s\n' % (sender, time.asctime()))
+                writeLocalMessage(self.file, _message, True)
+                # an empty line separates the messages
+                self.file.write('\n')
+                self.file.flush()
+            except:
+                exc_info = sys.exc_info()
+                try:
+                    self.file.truncate(start)
+                except IOError:
+                    pass
+                raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self.unlock()
+
+    def close(self):
+        """
+        Force the messages to disk and close the file.
+        """
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+
+# maximum number of messages written to a Maildir before they are forced to disk
+MAILDIR_MAX_PENDING = 64
+
+class MaildirWriter(object):
+    """
+    Delivers messages to a Maildir: each message is written to a new file in 'tmp' 
+    and renamed into 'new' once it is on disk. The files are forced to disk and renamed 
+    together by sync (or after MAILDIR_MAX_PENDING messages) instead of one by one, 
+    so a message is only delivered by sync (or close).
+    """
+    # unique number of the messages delivered by this process
+    counter = itertools.count()
+
+    def __init__(self, _directory):
+        import socket
+        self.directory = _directory
+        for sub in ('tmp', 'new', 'cur'):
+            path = os.path.join(_directory, sub)
+            if not os.path.isdir(path):
+                os.makedirs(path, 0700)
+        self.hostname = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+        # the (file, name) of the messages in 'tmp' which are not yet forced to disk
+        self.pending = []
+
+    def add(self, _fromAddress, _message):
+        """
+        Write the _message (a string or a file-like object) to 'tmp', see sync.
+        """
+        now = time.time()
+        name = '%i.M%iP%iQ%i.%s' % (now, now % 1 * 1e6, os.getpid(), MaildirWriter.counter.next(), self.hostname)
+        tmpName = os.path.join(self.directory, 'tmp', name)
+        f = os.fdopen(os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'wb')
+        try:
+            writeLocalMessage(f, _message)
+            f.flush()
+        except:
+            f.close()
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        self.pending.append( (f, name) )
+        if len(self.pending) >= MAILDIR_MAX_PENDING:
+            self.sync()
+
+    def sync(self):
+        """
+        Force the written messages to disk, rename them into 'new' and force the 
+        'new' directory to disk. If this fails the messages which are not renamed yet 
+        are removed from 'tmp'.
+        """
+        pending, self.pending = self.pending, []
+        renamed = False
+        try:
+            for f, name in pending:
+                os.fsync(f.fileno())
+            for f, name in pending:
+                f.close()
+            for f, name in pending:
+                os.rename(os.path.join(self.directory, 'tmp', name), os.path.join(self.directory, 'new', name))
+            renamed = True
+        finally:
+            if not renamed:
+                for f, name in pending:
+                    f.close()
+                    tmpName = os.path.join(self.directory, 'tmp', name)
+                    if os.path.exists(tmpName):
+                        os.remove(tmpName)
+        if pending and hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(os.path.join(self.directory, 'new'), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    close = sync
+
+class DeliverySession(object):
+    """
+    Delivers messages to the destination address during a single run.
+
+    The SMTP connection is opened on the first message and kept open for all
+    following messages (with a RSET in between). If the server dropped the connection
+    before a message (the RSET fails) it is transparently reopened, a message is not 
+    sent again when the connection fails later as the server may have accepted it. 
+    With MailServerMaxPerSession the connection is reopened after the given number 
+    of messages.
+
+    A session can be shared by the accounts which use the same mail server (see 
+    deliveryKey), the messages are sent one at a time.
+
+    With MboxFile or Maildir the messages are written directly to a local mbox file
+    or Maildir instead (see MboxWriter and MaildirWriter). The writes are batched:
+    the messages are only forced to disk (and delivered to a Maildir) by sync, 
+    which is called before the delivered messages are acknowledged.
+
+    Each of the hooks is called with a dictionary which describes a delivered message:
+    'method' ('SMTP', 'ProcMail', 'Mbox' or 'Maildir'), 'time' (seconds), 'bytes' and 'retries'.
+    """
+    def __init__(self, _prop_dict):
+        self.prop_dict = _prop_dict
+        # get the destination address
+        self.dstAddress = _prop_dict.get('DestinationAddress')
+        self.procmail = _prop_dict.get('ProcMail', 'false').lower() == 'true'
+        self.mboxFile = _prop_dict.get('MboxFile')
+        self.maildir = _prop_dict.get('Maildir')
+        if self.mboxFile and self.maildir:
+            raise ValueError("Only one of MboxFile and Maildir can be given. Exiting!")
+        if self.mboxFile:
+            self.method = 'Mbox'
+        elif self.maildir:
+            self.method = 'Maildir'
+        elif self.procmail:
+            self.method = 'ProcMail'
+        else:
+            self.method = 'SMTP'
+        if self.method in ('SMTP', 'ProcMail') and not self.dstAddress:
+            raise ValueError("DestinationAddress is required without MboxFile or Maildir. Exiting!")
+        # maximum number of messages per SMTP connection (0 is unlimited)
+        self.maxPerSession = int(_prop_dict.get('MailServerMaxPerSession', '0'))
+
+        self.smtp = None
+        # the MboxWriter or MaildirWriter of the messages which are not yet synced
+        self.writer = None
+        self.sessionCount = 0
+        self.lock = threading.Lock()
+        self.hooks = []
+
+    def connect(self):
+        """
+        Open (and if needed login to) the SMTP connection.
+        """
+        import smtplib
         # Get server and port info
-        server = _prop_dict.get('MailServer','localhost')
-        port = eval(_prop_dict.get('MailServerPort', '25'))
+        server = self.prop_dict.get('MailServer','localhost')
+        port = int(self.prop_dict.get('MailServerPort', '25'))
         s = smtplib.SMTP(server, port)
 
         # should we use TTLS
-        if _prop_dict.get('MailServerUseTTLS', 'false').lower() == 'true':
+        if self.prop_dict.get('MailServerUseTTLS', 'false').lower() == 'true':
             s.starttls()
 
         # check if we need to login
-        user = _prop_dict.get('MailServerUser', None)
-        password = _prop_dict.get('MailServerPassword', None)
+        user = self.prop_dict.get('MailServerUser', None)
+        password = self.prop_dict.get('MailServerPassword', None)
         if user and password:
             s.login(user, password)
 
-        # send the mail
-        s.sendmail(_fromAddress, dstAddress, _message)
+        self.smtp = s
+        self.sessionCount = 0
+
+    def sync(self):
+        """
+        Force the messages written to the mbox file or Maildir to disk.
+        """
+        self.lock.acquire()
+        try:
+            writer, self.writer = self.writer, None
+            if writer is not None:
+                writer.close()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """
+        Close the SMTP connection (if open) and sync the local delivery.
+        """
+        self.sync()
+        self.lock.acquire()
+        try:
+            if self.smtp is not None:
+                import smtplib
+                import socket
+                try:
+                    self.smtp.quit()
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    pass
+            self.smtp = None
+        finally:
+            self.lock.release()
+
+    def _sendSMTP(self, _fromAddress, _toAddress, _message):
+        """
+        Send the message over the (kept open) SMTP connection. Returns 1 if the 
+        connection was dropped by the server before the message and was reopened, else 0.
+        """
+        import smtplib
+        import socket
+        retries = 0
+        if self.smtp is not None and self.sessionCount > 0:
+            # reset the state of the previous mail transaction, 
+            # this also checks that the connection is still open
+            try:
+                code = self.smtp.rset()[0]
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                code = None
+            if code != 250:
+                try:
+                    self.smtp.close()
+                except socket.error:
+                    pass
+                self.smtp = None
+                retries = 1
+        if self.smtp is None:
+            self.connect()
+        try:
+            if isinstance(_message, basestring):
+                self.smtp.sendmail(_fromAddress, _toAddress, _message)
+            else:
+                sendStreamSMTP(self.smtp, _fromAddress, _toAddress, _message)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            # not sent again, the message may be accepted already (e.g. when the connection
+            # is lost after the end of the data), the next message uses a new connection
+            self.smtp = None
+            raise
+        self.sessionCount += 1
+        return retries
+
+    def send(self, _fromAddress, _message, _toAddress = None):
+        """
+        Sends an email to _toAddress (default the DestinationAddress of the session).
+        The _message is either a string or a file-like object (see owalib getMessageStream).
+        """
+        # the modules for delivery are only imported when a message is actually delivered
+        import shutil
+        import subprocess
+
+        start = time.time()
+        retries = 0
+        toAddress = _toAddress or self.dstAddress
+        method = self.method
+        if method in ('Mbox', 'Maildir'):
+            # write to the local mbox file or Maildir, see sync
+            self.lock.acquire()
+            try:
+                if self.writer is None:
+                    if method == 'Mbox':
+                        self.writer = MboxWriter(os.path.expanduser(self.mboxFile))
+                    else:
+                        self.writer = MaildirWriter(os.path.expanduser(self.maildir))
+                self.writer.add(_fromAddress, _message)
+            finally:
+                self.lock.release()
+        elif method == 'ProcMail':
+            # send via procmail like utility (DestinationAddress contains path to utility)
+            pmp = subprocess.Popen(toAddress, stdin=subprocess.PIPE)
+            if isinstance(_message, basestring):
+                pmp.communicate(_message)
+            else:
+                shutil.copyfileobj(_message, pmp.stdin, owalib.CHUNK_SIZE)
+                pmp.stdin.close()
+                pmp.wait()
+        else:
+            # send via SMTP
+            if self.maxPerSession and self.sessionCount >= self.maxPerSession:
+                self.close()
+            self.lock.acquire()
+            try:
+                retries = self._sendSMTP(_fromAddress, toAddress, _message)
+            finally:
+                self.lock.release()
+
+        if self.hooks:
+            if isinstance(_message, basestring):
+                size = len(_message)
+            else:
+                size = _message.tell()
+            record = {'method': method, 'time': time.time() - start, 'bytes': size, 'retries': retries}
+            for hook in self.hooks:
+                hook(record)
+
+def deliveryKey(_prop_dict):
+    """
+    Returns the settings which determine if accounts can share a DeliverySession.
+    """
+    return tuple([_prop_dict.get(p, '') for p in 
+                  ('MboxFile', 'Maildir', 'ProcMail', 'MailServer', 'MailServerPort', 'MailServerUseTTLS', 
+                   'MailServerUser', 'MailServerPassword', 'MailServerMaxPerSession')])
+
+def sendMail(_fromAddress, _message, _prop_dict, _session = None, _toAddress = None):
+    """
+    Sends an email to _toAddress (default the DestinationAddress).
+    If no DeliverySession is given a new one is used for this message only.
+    """
+    if _session is not None:
+        _session.send(_fromAddress, _message, _toAddress or _prop_dict.get('DestinationAddress'))
+        return
+
+    session = DeliverySession(_prop_dict)
+    try:
+        session.send(_fromAddress, _message, _toAddress)
+    finally:
+        session.close()
+
+class SyncState(object):
+    """
+    State of the incremental synchronisation of a folder, stored in a (JSON) file.
+
+    The watermark is the creation date of the oldest message which may still have
+    to be processed, only messages created at or after the watermark are listed.
+    The hrefs of the processed messages created at or after the watermark are 
+    remembered (with their creation date) so they are skipped in the next run.
+    """
+    def __init__(self, _fileName):
+        self.fileName = _fileName
+        self.watermark = None
+        self.seen = {}
+        # number of messages and last modification date of the folder after the last run
+        self.folderStamp = None
+        if os.path.exists(_fileName):
+            state = json.load(open(_fileName))
+            if state.get('watermark'):
+                self.watermark = str(state['watermark'])
+            self.seen = state.get('seen', {})
+            self.folderStamp = state.get('folderStamp')
+
+        # href -> creation date of the messages listed (and not skipped) in this run
+        self.listed = {}
+        # hrefs of the messages processed in this run
+        self.processed = set()
+
+    def isNew(self, _message):
+        """
+        Returns True if the message still has to be processed (and remembers it as listed).
+        """
+        if _message['href'] in self.seen:
+            return False
+        self.listed[_message['href']] = _message['creationdate']
+        return True
+
+    def setProcessed(self, _href):
+        """
+        Remember that the message is processed (delivered and acknowledged).
+        """
+        self.processed.add(_href)
+
+    def save(self):
+        """
+        Move the watermark and write the state to the file.
+        """
+        # messages without a creation date don't move the watermark
+        dates = [date for href, date in self.listed.items() if date]
+        pending = [date for href, date in self.listed.items() if date and href not in self.processed]
+        if pending:
+            # keep listing the oldest message which isn't processed
+            self.watermark = min(pending)
+        elif dates:
+            self.watermark = max(dates)
+
+        seen = self.seen
+        seen.update([(href, self.listed[href]) for href in self.processed])
+        self.seen = dict([(href, date) for href, date in seen.items() 
+                          if self.watermark is None or date >= self.watermark])
+
+        # write to a temporary file first so the state is never half written
+        tmpName = self.fileName + '.tmp'
+        f = open(tmpName, 'w')
+        json.dump({'watermark': self.watermark, 'seen': self.seen, 
+                   'folderStamp': self.folderStamp}, f)
+        f.close()
+        os.rename(tmpName, self.fileName)
+
+class SessionCache(object):
+    """
+    Cache of the authentication cookie and the discovered root and inbox paths,
+    stored in a (JSON) file which is only readable and writable by the user.
+    The cache is only used for the same server, exchange path and user.
+    """
+    def __init__(self, _fileName, _key):
+        self.fileName = _fileName
+        self.key = _key
+        self.session = None
+        if os.path.exists(_fileName):
+            try:
+                session = json.load(open(_fileName))
+            except ValueError:
+                session = {}
+            if session.get('key') == _key:
+                self.session = session
+
+    def get(self):
+        """
+        Returns the cached (cookie, root path, inbox path) tuple or None.
+        """
+        if self.session is None:
+            return None
+        return tuple([str(self.session[k]) for k in ('cookie', 'rootPath', 'inboxPath')])
+
+    def save(self, _cookie, _rootPath, _inboxPath):
+        """
+        Write the session to the cache file.
+        """
+        self.session = {'key': self.key, 'cookie': _cookie, 
+                        'rootPath': _rootPath, 'inboxPath': _inboxPath}
+        # create a new temporary file only accessible by the user
+        tmpName = self.fileName + '.tmp'
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        f = os.fdopen(os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), 'w')
+        json.dump(self.session, f)
+        f.close()
+        os.rename(tmpName, self.fileName)
+
+class FolderCache(object):
+    """
+    Cache of the folder hierarchy (see owalib findFolders), stored in a (JSON) file.
+    """
+    def __init__(self, _fileName):
+        self.fileName = _fileName
+        # href of a folder -> last modification date and subfolders
+        self.folders = {}
+        if os.path.exists(_fileName):
+            try:
+                folders = json.load(open(_fileName))
+            except ValueError:
+                folders = {}
+            for href, cached in folders.items():
+                subFolders = [{'href': str(f['href']), 'name': f['name'].encode('utf-8'), 
+                               'lastmodified': str(f['lastmodified']), 'hassubs': f['hassubs']}
+                              for f in cached['folders']]
+                self.folders[str(href)] = {'lastmodified': str(cached['lastmodified']), 
+                                           'listed': cached.get('listed', 0),
+                                           'folders': subFolders}
+
+    def save(self):
+        """
+        Write the cache to the file.
+        """
+        tmpName = self.fileName + '.tmp'
+        f = open(tmpName, 'w')
+        json.dump(self.folders, f)
+        f.close()
+        os.rename(tmpName, self.fileName)
+
+def getMessageId(_message):
+    """
+    Returns the Message-ID header of the (file-like) _message or None.
+    Only the header is read, the file is rewound afterwards.
+    """
+    messageId = None
+    name = None
+    while True:
+        line = _message.readline()
+        if not line.strip():
+            break
+        if line[0] in ' \t':
+            # continuation of a folded header
+            if name == 'message-id' and not messageId:
+                messageId = line.strip()
+            continue
+        name = line.split(':', 1)[0].strip().lower()
+        if name == 'message-id':
+            messageId = line.split(':', 1)[1].strip()
+    _message.seek(0)
+    return messageId or None
+
+def getMessageVersion(_m):
+    """
+    Returns the version of a listed message under which it is cached (see owalib MessageCache):
+    its creation (or receive) date and size, with the Message-ID if it was prefetched (see 
+    PrefetchHeaders). The href alone is not enough, the server reuses the href of a deleted 
+    message for a new message with the same subject. Returns None (the message is not cached) 
+    if there is no date or Message-ID to identify the message.
+    The last modification time is not used, it changes when a message is marked as read.
+    """
+    date = _m.get('creationdate') or _m.get('datereceived')
+    messageId = _m.get('headers', {}).get('message-id')
+    if not date and not messageId:
+        return None
+    return '%s %s %s' % (date or '', _m.get('size'), messageId or '')
 
-        # close the session
-        s.quit()
+# the headers which are listed for the rule if no PrefetchHeaders are given
+DEFAULT_PREFETCH_HEADERS = ['Message-ID', 'To', 'List-Id', 'Date']
+
+# the actions a rule can return for a message (or an address to deliver the message to)
+RULE_ACTIONS = ('deliver', 'skip', 'defer')
+
+def loadRules(_fileName):
+    """
+    Load the function 'rule' from the Python file _fileName (see RulesFile in example.properties).
+    """
+    namespace = {}
+    execfile(_fileName, namespace)
+    if not callable(namespace.get('rule')):
+        raise ValueError("No function 'rule' in the rules file %s. Exiting!" % _fileName)
+    return namespace['rule']
+
+def getQuery(_prop_dict):
+    """
+    Returns the owalib Query for the Filter properties or None if there are none.
+    """
+    query = owalib.Query()
+    if _prop_dict.get('FilterFrom'):
+        query.fromAddress(*[a.strip() for a in _prop_dict['FilterFrom'].split(',') if a.strip()])
+    if _prop_dict.get('FilterSubject'):
+        query.subjectLike(_prop_dict['FilterSubject'])
+    if _prop_dict.get('FilterSince'):
+        query.receivedSince(_prop_dict['FilterSince'])
+    if _prop_dict.get('FilterBefore'):
+        query.receivedBefore(_prop_dict['FilterBefore'])
+    if _prop_dict.get('FilterMinSize'):
+        query.minSize(int(_prop_dict['FilterMinSize']))
+    if _prop_dict.get('FilterMaxSize'):
+        query.maxSize(int(_prop_dict['FilterMaxSize']))
+    if not query.conditions:
+        return None
+    return query
+
+# number of seconds a delivered message which is never acknowledged is kept in the journal
+JOURNAL_MAX_AGE = 7 * 24 * 3600
+
+class Journal(object):
+    """
+    Append-only journal of the messages which are fetched, delivered and acknowledged,
+    so a message which was delivered before owafetch stopped (or crashed) is only 
+    acknowledged in the next run instead of being downloaded and delivered again.
+
+    Each line of the file is a JSON list: [state, time, href, Message-ID].
+    The last line of a message determines its state. The records are written to the
+    file immediately, so they survive a crash of the program, but are only synced 
+    to disk in batches (see sync). When the journal is compacted only the delivered 
+    messages which aren't acknowledged are kept.
+    """
+    FETCHED = 'fetched'
+    DELIVERED = 'delivered'
+    ACKNOWLEDGED = 'acknowledged'
+
+    def __init__(self, _fileName, _maxAge = JOURNAL_MAX_AGE):
+        self.fileName = _fileName
+        self.maxAge = _maxAge
+        self.lock = threading.Lock()
+        self.file = None
+        self.dirty = False
+        # href -> (state, time, Message-ID)
+        self.entries = {}
+        # Message-ID -> href of the delivered messages of earlier runs (read from the file),
+        # a message with the same Message-ID delivered by this process can be another copy
+        self.messageIds = {}
+        if os.path.exists(_fileName):
+            for line in open(_fileName):
+                try:
+                    state, t, href, messageId = json.loads(line)
+                except ValueError:
+                    # the last line can be incomplete after a crash
+                    continue
+                self.update(state, t, str(href), messageId and str(messageId), True)
+
+    def update(self, _state, _time, _href, _messageId, _earlierRun = False):
+        """
+        Update the state of a message in memory.
+        """
+        old = self.entries.pop(_href, None)
+        if old is not None and old[2] is not None and self.messageIds.get(old[2]) == _href:
+            del self.messageIds[old[2]]
+        if _state == Journal.ACKNOWLEDGED:
+            return
+        self.entries[_href] = (_state, _time, _messageId)
+        if _state == Journal.DELIVERED and _messageId is not None and _earlierRun:
+            self.messageIds[_messageId] = _href
+
+    def record(self, _state, _href, _messageId = None):
+        """
+        Append the new state of a message to the journal.
+        """
+        self.lock.acquire()
+        try:
+            t = time.time()
+            self.update(_state, t, _href, _messageId)
+            if self.file is None:
+                self.file = open(self.fileName, 'a')
+            self.file.write(json.dumps([_state, t, _href, _messageId]) + '\n')
+            self.file.flush()
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+    def isDelivered(self, _href):
+        """
+        Returns True if the message is delivered but not acknowledged.
+        """
+        return self.entries.get(_href, (None,))[0] == Journal.DELIVERED
+
+    def deliveredAs(self, _messageId):
+        """
+        Returns the href of a message with the Message-ID which was delivered (and not 
+        acknowledged) in an earlier run, which is read from the journal file, or None.
+        The messages delivered by this process are only matched by href (see isDelivered).
+        """
+        if _messageId is None:
+            return None
+        return self.messageIds.get(_messageId)
+
+    def sync(self):
+        """
+        Write the records appended since the last sync to disk.
+        """
+        self.lock.acquire()
+        try:
+            if self.file is not None and self.dirty:
+                os.fsync(self.file.fileno())
+                self.dirty = False
+        finally:
+            self.lock.release()
+
+    def compact(self):
+        """
+        Rewrite the journal with only the delivered messages which aren't 
+        acknowledged (and are not older than maxAge seconds).
+        """
+        self.lock.acquire()
+        try:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.dirty = False
+            oldest = time.time() - self.maxAge
+            for href, (state, t, messageId) in self.entries.items():
+                if state != Journal.DELIVERED or t < oldest:
+                    self.update(Journal.ACKNOWLEDGED, t, href, messageId)
+
+            # write to a temporary file first so the journal is never half written
+            tmpName = self.fileName + '.tmp'
+            f = open(tmpName, 'w')
+            for href, (state, t, messageId) in self.entries.items():
+                f.write(json.dumps([state, t, href, messageId]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmpName, self.fileName)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """
+        Sync and close the journal file.
+        """
+        self.sync()
+        self.lock.acquire()
+        try:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        finally:
+            self.lock.release()
 
 # List of required properties 
 PROPERTIES = [
@@ -94,16 +899,48 @@ PROPERTIES = [
     ('ProxyPort', 'UNSUPPORTED'),
     ('Delete', 'OPTIONAl'),
     ('All', 'OPTIONAl'),
+    ('BatchSize', 'OPTIONAL'),
+    ('PageSize', 'OPTIONAL'),
+    ('Incremental', 'OPTIONAL'),
+    ('SyncStateFile', 'OPTIONAL'),
+    ('Journal', 'OPTIONAL'),
+    ('JournalFile', 'OPTIONAL'),
+    ('MessageCache', 'OPTIONAL'),
+    ('MessageCacheDir', 'OPTIONAL'),
+    ('MessageCacheSize', 'OPTIONAL'),
+    ('CacheSession', 'OPTIONAL'),
+    ('SessionCacheFile', 'OPTIONAL'),
+    ('Concurrency', 'OPTIONAL'),
+    ('SpoolSize', 'OPTIONAL'),
+    ('PipelineDepth', 'OPTIONAL'),
+    ('Compression', 'OPTIONAL'),
+    ('Retries', 'OPTIONAL'),
+    ('SmallFirst', 'OPTIONAL'),
+    ('MaxBytesPerRun', 'OPTIONAL'),
+    ('MaxMessageSize', 'OPTIONAL'),
+    ('PrefetchHeaders', 'OPTIONAL'),
+    ('RulesFile', 'OPTIONAL'),
+    ('Folders', 'OPTIONAL'),
+    ('FolderCacheFile', 'OPTIONAL'),
+    ('FolderCacheMaxAge', 'OPTIONAL'),
+    ('FilterFrom', 'OPTIONAL'),
+    ('FilterSubject', 'OPTIONAL'),
+    ('FilterSince', 'OPTIONAL'),
+    ('FilterBefore', 'OPTIONAL'),
+    ('FilterMinSize', 'OPTIONAL'),
+    ('FilterMaxSize', 'OPTIONAL'),
     ('DestinationAddress', 'OPTIONAL'),
     ('ForceFrom', 'UNSUPPORTED'),
     ('ForceFromAddr', 'UNSUPPORTED'),
-    ('MboxFile', 'UNSUPPORTED'),
+    ('MboxFile', 'OPTIONAL'),
+    ('Maildir', 'OPTIONAL'),
     ('ProcMail', 'OPTIONAL'),
     ('MailServer', 'OPTIONAL'),
     ('MailServerPort', 'OPTIONAL'),
     ('MailServerUseTTLS', 'OPTIONAL'),
     ('MailServerUser', 'OPTIONAL'),
     ('MailServerPassword', 'OPTIONAL'),
+    ('MailServerMaxPerSession', 'OPTIONAL'),
     ('NoEightBitMime', 'UNSUPPORTED'),
     ]
 
@@ -183,23 +1020,984 @@ class FetchExcLoggingFilter(logging.Filter):
     def filter(self, record):
         # define the prefix to add to each line
         prefix = self.prefixes.get(record.levelno, "")
+        # the messages of an account (logger FetchExc.<account>) are prefixed with the account name
+        account = record.name.split('.', 1)[1:]
+        if account:
+            prefix = "%s [%s]" % (prefix, account[0])
         # split the string at line breaks and add prefix to each new line
         record.msg = "\n".join(["%s %s" % (prefix, line) for line in record.msg.split('\n')])
         return True
 
 
+# maximum number of requests (and deliveries) kept by Stats
+STATS_WINDOW = 100000
+
+def percentile(_values, _percent):
+    """
+    Returns the _percent percentile (nearest rank) of the sorted list _values.
+    """
+    if not _values:
+        return None
+    rank = int(math.ceil(_percent / 100.0 * len(_values)))
+    return _values[max(0, rank - 1)]
+
+class Stats(object):
+    """
+    Collects the timing of the requests to the server and of the deliveries 
+    (see the hooks of OWAConnectionPlugin.do_request and DeliverySession). 
+    Attach it to the fetchers of all accounts to get a single summary.
+    Only the last STATS_WINDOW requests and deliveries are kept (for daemon mode).
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.requests = collections.deque(maxlen=STATS_WINDOW)
+        self.deliveries = collections.deque(maxlen=STATS_WINDOW)
+        # the message caches of the fetchers (see MessageCache)
+        self.caches = []
+
+    def attach(self, _fetcher):
+        if self.addRequest not in _fetcher.owa.requestHooks:
+            _fetcher.owa.requestHooks.append(self.addRequest)
+        if self.addDelivery not in _fetcher.delivery.hooks:
+            _fetcher.delivery.hooks.append(self.addDelivery)
+        cache = _fetcher.owa.messageCache
+        if cache is not None and cache not in self.caches:
+            self.caches.append(cache)
+
+    def addRequest(self, _record):
+        self.requests.append(_record)
+
+    def addDelivery(self, _record):
+        self.deliveries.append(_record)
+
+    def summary(self):
+        """
+        Returns the summary as a dictionary (which can be written as JSON).
+        """
+        elapsed = time.time() - self.start
+        methods = {}
+        for r in list(self.requests):
+            m = methods.setdefault(r['method'], {'requests': 0, 'errors': 0, 'retries': 0, 
+                                                 'reauthenticated': 0, 'sent': 0, 'received': 0, 
+                                                 'times': []})
+            m['requests'] += 1
+            if r['status'] is None or r['status'] >= 400:
+                m['errors'] += 1
+            m['retries'] += r['retries']
+            m['reauthenticated'] += int(r['reauthenticated'])
+            m['sent'] += r['sent']
+            m['received'] += r['received']
+            m['times'].append(r['time'])
+        for m in methods.values():
+            times = sorted(m.pop('times'))
+            m['p50'] = percentile(times, 50)
+            m['p95'] = percentile(times, 95)
+            m['max'] = times[-1]
+
+        deliveries = list(self.deliveries)
+        delivered = len(deliveries)
+        deliveredBytes = sum([d['bytes'] for d in deliveries])
+        received = sum([m['received'] for m in methods.values()])
+        return {'elapsed': elapsed,
+                'methods': methods,
+                'messages': delivered,
+                'messagesPerSecond': delivered / max(elapsed, 1e-6),
+                'bytesDelivered': deliveredBytes,
+                'bytesReceived': received,
+                'mbPerSecond': received / max(elapsed, 1e-6) / 1e6,
+                'deliveryTime': sum([d['time'] for d in deliveries]),
+                'deliveryRetries': sum([d['retries'] for d in deliveries]),
+                'cacheHits': sum([c.hits for c in self.caches]),
+                'cacheMisses': sum([c.misses for c in self.caches]),
+                'cacheBytes': sum([c.hitBytes for c in self.caches])}
+
+    def format(self):
+        """
+        Returns the summary as text.
+        """
+        s = self.summary()
+        lines = ['Statistics after %.2f seconds:' % s['elapsed']]
+        for name in sorted(s['methods']):
+            m = s['methods'][name]
+            lines.append('%-10s %5i request(s), p50 %.3f s, p95 %.3f s, max %.3f s, %i error(s), '
+                         '%i retries, %.2f MB received' % 
+                         (name, m['requests'], m['p50'], m['p95'], m['max'], m['errors'], 
+                          m['retries'] + m['reauthenticated'], m['received'] / 1e6))
+        lines.append('Delivered %i message(s), %.1f messages/s, %.2f MB/s received, '
+                     '%.2f s delivering' % (s['messages'], s['messagesPerSecond'], 
+                                            s['mbPerSecond'], s['deliveryTime']))
+        if self.caches:
+            lines.append('Message cache: %i hit(s), %i miss(es), %.2f MB read from the cache' % 
+                         (s['cacheHits'], s['cacheMisses'], s['cacheBytes'] / 1e6))
+        return '\n'.join(lines)
+
+    def write(self, _fileName):
+        """
+        Write the summary as JSON (atomically, for monitoring which reads the file).
+        """
+        tmpName = _fileName + '.tmp'
+        f = open(tmpName, 'w')
+        try:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmpName, _fileName)
+
+# default maximum number of messages waiting between the stages of the pipeline
+DEFAULT_PIPELINE_DEPTH = 4
+
+class PipelineStage(object):
+    """
+    Statistics of a stage of the pipeline in Fetcher.deliverAll.
+    """
+    def __init__(self, _name):
+        self.name = _name
+        self.count = 0
+        self.bytes = 0
+        self.busy = 0.0
+        # depth of the input queue of the stage
+        self.samples = 0
+        self.depthSum = 0
+        self.depthMax = 0
+
+    def add(self, _time, _bytes, _count = 1):
+        self.count += _count
+        self.bytes += _bytes
+        self.busy += _time
+
+    def sample(self, _queue):
+        depth = _queue.qsize()
+        self.samples += 1
+        self.depthSum += depth
+        self.depthMax = max(self.depthMax, depth)
+
+    def report(self, _log):
+        rate = ''
+        if self.busy > 0:
+            rate = ' (%.1f msg/s' % (self.count / self.busy)
+            if self.bytes:
+                rate += ', %.2f MB/s' % (self.bytes / self.busy / 1e6)
+            rate += ')'
+        depth = ''
+        if self.samples:
+            depth = ', queue depth max %i avg %.1f' % (self.depthMax, float(self.depthSum) / self.samples)
+        _log.debug('Pipeline %s: %i message(s) in %.2f s%s%s' % 
+                   (self.name, self.count, self.busy, rate, depth))
+
+class Fetcher(object):
+    """
+    Fetches the mail of the account in a properties file and forwards it.
+    The connection to the server (and the delivery session) are kept 
+    between the calls to run, so it can be used to poll the server.
+    If a _delivery session is given it is shared with other accounts.
+    """
+    def __init__(self, _prop_dict, _propertiesFile, _options, _log, _delivery = None):
+        self.prop_dict = _prop_dict
+        self.propertiesFile = _propertiesFile
+        self.options = _options
+        self.log = _log
+
+        # get the full username with the domain part
+        self.fullUserName = "%s\\%s" % (_prop_dict["Domain"], _prop_dict["Username"])
+
+        # Create the OWA session
+        secure = _prop_dict.get('Secure', 'false').lower() == 'true'
+        self.owa  = owalib.OWAConnectionClass(secure)(_prop_dict["ExchangeServer"])
+        self.owa.compression = _prop_dict.get('Compression', 'false').lower() == 'true'
+        self.owa.retries = int(_prop_dict.get('Retries', owalib.DEFAULT_RETRIES))
+        # the downloaded messages are cached on disk to skip downloading them again
+        if _prop_dict.get('MessageCache', 'false').lower() == 'true':
+            cacheDir = _prop_dict.get('MessageCacheDir', _propertiesFile + '.cache')
+            self.owa.messageCache = owalib.MessageCache(os.path.expanduser(cacheDir), 
+                                                        int(_prop_dict.get('MessageCacheSize', 
+                                                                           owalib.DEFAULT_CACHE_SIZE)))
+        self.rootPath = None
+        self.inboxPath = None
+        # True if the session was just authenticated (and not taken from the cache)
+        self.authenticated = False
+
+        # the authentication cookie and the paths can be cached between runs
+        self.sessionCache = None
+        if _prop_dict.get('CacheSession', 'false').lower() == 'true':
+            sessionCacheFile = _prop_dict.get('SessionCacheFile', _propertiesFile + '.session')
+            self.sessionCache = SessionCache(os.path.expanduser(sessionCacheFile),
+                                             '%s/%s/%s' % (_prop_dict["ExchangeServer"], 
+                                                           _prop_dict['ExchangePath'], self.fullUserName))
+
+        # the states of the messages are journaled to recover from a crash during delivery
+        self.journal = None
+        if _prop_dict.get('Journal', 'false').lower() == 'true':
+            journalFile = _prop_dict.get('JournalFile', _propertiesFile + '.journal')
+            self.journal = Journal(os.path.expanduser(journalFile))
+
+        # see which messages to list (default only unread)
+        if _options.AllMessages or _prop_dict.get("All",'false').lower() == 'true':
+            self.message_type = ""
+            self.fetchAll = True
+        else:
+            self.message_type = " unread"
+            self.fetchAll = False
+
+        # number of delivered messages to mark as read (or delete) in one request
+        self.batchSize = int(_prop_dict.get('BatchSize', owalib.DEFAULT_BATCH_SIZE))
+        self.delete = _prop_dict.get('Delete','false').lower() == 'true'
+        # list the messages in pages of PageSize messages if given
+        self.pageSize = int(_prop_dict.get('PageSize', '0'))
+        # download the messages over a pool of connections if Concurrency > 1
+        self.concurrency = int(_prop_dict.get('Concurrency', '1'))
+        self.pool = None
+        # messages larger than SpoolSize bytes are kept in a temporary file until delivered
+        self.spoolSize = int(_prop_dict.get('SpoolSize', owalib.DEFAULT_SPOOL_SIZE))
+        # maximum number of messages waiting between the stages of the pipeline
+        self.pipelineDepth = max(1, int(_prop_dict.get('PipelineDepth', DEFAULT_PIPELINE_DEPTH)))
+        # connection used to acknowledge the delivered messages
+        self.ackOwa = None
+        # order and limits of the downloads based on the size of the messages in the listing
+        self.smallFirst = _prop_dict.get('SmallFirst', 'false').lower() == 'true'
+        self.maxBytesPerRun = int(_prop_dict.get('MaxBytesPerRun', '0'))
+        self.maxMessageSize = int(_prop_dict.get('MaxMessageSize', '0'))
+        # the rule decides, based on the listing, to deliver, skip, defer or route a message
+        self.rule = None
+        if _prop_dict.get('RulesFile'):
+            self.rule = loadRules(os.path.expanduser(_prop_dict['RulesFile']))
+        # the headers of the messages which are returned by the listing
+        headers = _prop_dict.get('PrefetchHeaders')
+        if headers is None:
+            headers = self.rule is not None and ','.join(DEFAULT_PREFETCH_HEADERS) or ''
+        self.headers = [h.strip() for h in headers.split(',') if h.strip()]
+        # only the messages which match the Filter properties are listed by the server
+        self.query = getQuery(_prop_dict)
+        # the folders to fetch from besides (or instead of) the inbox, the folder hierarchy is cached
+        self.folderNames = [f.strip() for f in _prop_dict.get('Folders', '').split(',') if f.strip()]
+        self.folderCache = None
+        if self.folderNames:
+            folderCacheFile = _prop_dict.get('FolderCacheFile', _propertiesFile + '.folders')
+            self.folderCache = FolderCache(os.path.expanduser(folderCacheFile))
+        self.folderCacheAge = int(_prop_dict.get('FolderCacheMaxAge', owalib.DEFAULT_FOLDER_CACHE_AGE))
+
+        # the session used to deliver the messages
+        self.ownsDelivery = _delivery is None
+        if self.ownsDelivery:
+            _delivery = DeliverySession(_prop_dict)
+        self.delivery = _delivery
+
+    def login(self):
+        """
+        Authenticate with Form Based Authentication (FBA) and discover the root and inbox paths.
+        """
+        # the other connections share the authentication cookie of the old session
+        self.closeClones()
+
+        fbapath = self.prop_dict.get('FBApath', '/exchweb/bin/auth/owaauth.dll')
+        self.owa.doFBA(self.fullUserName, self.prop_dict['Password'], 
+                       self.prop_dict['ExchangePath'], fbapath)
+
+        # get the users root path on the server
+        self.rootPath = self.owa.getRootPath(self.prop_dict["ExchangePath"])
+        self.log.debug('Found user root path: %s' % self.rootPath)
+
+        # get the users inbox path
+        self.inboxPath = self.owa.getInboxPath(self.rootPath)
+        self.log.debug('Found inbox path: %s' % self.inboxPath)
+
+        if self.sessionCache is not None:
+            self.sessionCache.save(self.owa.authentication_header['Cookie'], 
+                                   self.rootPath, self.inboxPath)
+        self.authenticated = True
+
+    def connect(self):
+        """
+        Use the cached session if available, else authenticate.
+        """
+        cachedSession = None
+        if self.sessionCache is not None:
+            cachedSession = self.sessionCache.get()
+        if cachedSession is not None:
+            cookie, self.rootPath, self.inboxPath = cachedSession
+            self.owa.authentication_header = {'Cookie': cookie}
+            self.authenticated = False
+            self.log.debug('Using cached session, inbox path: %s' % self.inboxPath)
+        else:
+            self.login()
+
+    def getFolderCounts(self):
+        """
+        Get the number of (unread) messages in the inbox with a single small request.
+        Authenticates again if the session is no longer valid.
+        """
+        if self.inboxPath is None:
+            self.connect()
+        try:
+            counts = self.owa.getFolderCounts(self.inboxPath)
+        except owalib.SessionError, e:
+            if self.authenticated:
+                raise
+            # the cached (or previous) session is no longer valid
+            self.log.debug('Session not valid (%s), authenticating again.' % e)
+            self.login()
+            counts = self.owa.getFolderCounts(self.inboxPath)
+        self.authenticated = False
+        self.log.debug('Inbox has %s unread and %s visible message(s).' % 
+                       (counts['unreadcount'], counts['visiblecount']))
+        return counts
+
+    def reset(self):
+        """
+        Close the connections after an error, they are opened again when needed.
+        """
+        self.owa.close()
+        self.closeClones()
+        if self.ownsDelivery:
+            self.delivery.close()
+
+    def deliverAll(self, _messages, _acknowledge):
+        """
+        Download, deliver and acknowledge the _messages (see iterParseMessages) in a pipeline.
+        Each stage runs in its own thread with bounded queues in between, so the 
+        downloading of the next messages continues while a message is delivered.
+        A message is only acknowledged (with _acknowledge, in batches) after it 
+        has been delivered. Errors of any stage stop the pipeline and are raised.
+        With a journal the messages which were delivered in an earlier run (but not
+        acknowledged) are acknowledged without downloading and delivering them again.
+        """
+        log = self.log
+        journal = self.journal
+
+        def isDelivered(_m):
+            # with prefetched headers the Message-ID is known before downloading
+            messageId = _m.get('headers', {}).get('message-id') or None
+            return journal.isDelivered(_m["href"]) or journal.deliveredAs(messageId) is not None
+        downloaded = Queue.Queue(self.pipelineDepth)
+        acks = Queue.Queue(self.pipelineDepth)
+        stopped = threading.Event()
+        downloadErrors = []
+        ackErrors = []
+        # the Message-IDs of the messages written to a Maildir which are journaled as 
+        # delivered when they are synced (by href)
+        unsynced = {}
+        download = PipelineStage('download')
+        deliver = PipelineStage('deliver')
+        acknowledge = PipelineStage('acknowledge')
+
+        def downloadAll():
+            try:
+                # the messages are listed (lazily) once and used twice: for fetching and for logging,
+                # the messages delivered in an earlier run are not fetched
+                messages = ((m, journal is not None and isDelivered(m)) for m in _messages)
+                messages, fetchMessages = itertools.tee(messages)
+                fetchMessages = (m for m, delivered in fetchMessages if not delivered)
+                if self.concurrency > 1:
+                    streams = (message for m, message in 
+                               self.getPool().imap(lambda conn, m: conn.getMessageStream(m["href"], self.spoolSize, 
+                                                                                         getMessageVersion(m)), 
+                                                   fetchMessages))
+                else:
+                    streams = (self.owa.getMessageStream(m["href"], self.spoolSize, getMessageVersion(m)) 
+                               for m in fetchMessages)
+                while not stopped.isSet():
+                    start = time.time()
+                    try:
+                        m, delivered = messages.next()
+                        if delivered:
+                            downloaded.put( (m, None) )
+                            continue
+                        message = streams.next()
+                    except StopIteration:
+                        break
+                    message.seek(0, 2)
+                    download.add(time.time() - start, message.tell())
+                    message.seek(0)
+                    if journal is not None:
+                        journal.record(Journal.FETCHED, m["href"])
+                    downloaded.put( (m, message) )
+            except Exception:
+                downloadErrors.append(sys.exc_info())
+            downloaded.put(None)
+
+        def acknowledgeAll():
+            batch = []
+            while True:
+                acknowledge.sample(acks)
+                item = acks.get()
+                if item is not None:
+                    batch.append(item)
+                if batch and (item is None or len(batch) >= self.batchSize):
+                    if not ackErrors:
+                        start = time.time()
+                        try:
+                            # the local delivery is forced to disk before the messages are acknowledged
+                            self.delivery.sync()
+                            for i, m in batch:
+                                if m["href"] in unsynced:
+                                    journal.record(Journal.DELIVERED, m["href"], unsynced.pop(m["href"]))
+                            _acknowledge(batch)
+                        except Exception:
+                            ackErrors.append(sys.exc_info())
+                        acknowledge.add(time.time() - start, 0, len(batch))
+                    batch = []
+                if item is None:
+                    break
+
+        threads = [threading.Thread(target=downloadAll), threading.Thread(target=acknowledgeAll)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+
+        item = True
+        try:
+            i = 0
+            while True:
+                deliver.sample(downloaded)
+                item = downloaded.get()
+                if item is None:
+                    break
+                if ackErrors:
+                    e = ackErrors[0]
+                    raise e[0], e[1], e[2]
+                m, message = item
+                messageId = None
+                if journal is not None and message is not None:
+                    messageId = getMessageId(message)
+                    if journal.deliveredAs(messageId) is not None:
+                        # delivered in an earlier run with another href
+                        message.close()
+                        message = None
+                if message is None:
+                    log.info('Mail %i was delivered before: (%s)%s' % (i, m["fromemail"], m["subject"]))
+                else:
+                    log.info('Sending mail %i: (%s)%s' % (i, m["fromemail"], m["subject"]))
+                    start = time.time()
+                    try:
+                        sendMail(m["fromemail"], message, self.prop_dict, self.delivery, m.get('destination'))
+                    finally:
+                        message.close()
+                    deliver.add(time.time() - start, 0)
+                if journal is not None:
+                    if message is not None and self.delivery.method == 'Maildir':
+                        # only delivered by the sync before the acknowledgement (see MaildirWriter)
+                        unsynced[m["href"]] = messageId
+                    else:
+                        journal.record(Journal.DELIVERED, m["href"], messageId)
+                acks.put( (i, m) )
+                i += 1
+        finally:
+            # stop the download and acknowledge the delivered messages
+            stopped.set()
+            while item is not None:
+                item = downloaded.get()
+                if item is not None and item[1] is not None:
+                    item[1].close()
+            acks.put(None)
+            for t in threads:
+                t.join()
+            for stage in [download, deliver, acknowledge]:
+                stage.report(log)
+
+        for errors in [downloadErrors, ackErrors]:
+            if errors:
+                e = errors[0]
+                raise e[0], e[1], e[2]
+
+    def applyRule(self, _page, _syncState = None):
+        """
+        Apply the rule (see RulesFile) to the messages of a page of the listing.
+        Returns the messages to deliver and the number of deferred messages. 
+        A message routed to another address gets that address as 'destination'.
+        Skipped and deferred messages are left on the server, with Incremental 
+        a skipped message is not listed again.
+        """
+        page = []
+        deferred = 0
+        for m in _page:
+            try:
+                action = self.rule(m) or 'deliver'
+            except Exception, e:
+                self.log.error('Rule failed for message (%s)%s, delivering it: %s: %s' % 
+                               (m['fromemail'], m['subject'], e.__class__.__name__, e))
+                action = 'deliver'
+            if action not in RULE_ACTIONS and (not isinstance(action, basestring) or '@' not in action):
+                self.log.warning('Unknown rule action %r for message (%s)%s, delivering it.' % 
+                                 (action, m['fromemail'], m['subject']))
+                action = 'deliver'
+
+            if action == 'skip':
+                self.log.info('Skipping message (%s)%s (rule).' % (m['fromemail'], m['subject']))
+                if _syncState is not None:
+                    _syncState.setProcessed(m['href'])
+            elif action == 'defer':
+                self.log.debug('Deferring message (%s)%s (rule).' % (m['fromemail'], m['subject']))
+                deferred += 1
+            else:
+                if action != 'deliver':
+                    if self.delivery.method != 'SMTP':
+                        self.log.warning('Can\'t route message (%s)%s to %s with %s.' % 
+                                         (m['fromemail'], m['subject'], action, self.delivery.method))
+                    else:
+                        m['destination'] = action
+                page.append(m)
+        return page, deferred
+
+    def schedule(self, _page, _syncState = None):
+        """
+        Returns the messages of a page of the listing in the order to download them.
+        Messages larger than MaxMessageSize are left on the server (with Incremental
+        they are not listed again), with SmallFirst the smallest messages are downloaded 
+        first (within the page).
+        """
+        if self.maxMessageSize > 0:
+            page = []
+            for m in _page:
+                if m['size'] is not None and m['size'] > self.maxMessageSize:
+                    self.log.warning('Skipping message (%s)%s of %i bytes, larger than MaxMessageSize.' % 
+                                     (m['fromemail'], m['subject'], m['size']))
+                    if _syncState is not None:
+                        _syncState.setProcessed(m['href'])
+                else:
+                    page.append(m)
+            _page = page
+        if self.smallFirst:
+            # messages of unknown size last
+            _page = sorted(_page, key=lambda m: m['size'] is None and sys.maxint or m['size'])
+        return _page
+
+    def getPool(self):
+        """
+        Returns the pool of Concurrency connections, which is created when first needed.
+        """
+        if self.pool is None:
+            self.pool = owalib.OWAConnectionPool(self.owa, self.concurrency)
+        return self.pool
+
+    def imap(self, _function, _items):
+        """
+        Calls _function(connection, item) for each of the _items, concurrently on the pool 
+        if Concurrency > 1 (see owalib OWAConnectionPool imap), else on the connection.
+        This is a generator which yields (item, result) tuples in the order of _items.
+        """
+        if self.concurrency > 1:
+            return self.getPool().imap(_function, _items)
+        return ((item, _function(self.owa, item)) for item in _items)
+
+    def getFolders(self, _inboxModified = None):
+        """
+        Returns the (name, path) tuples of the folders to fetch the messages from (see Folders),
+        by default only the inbox. The folders are found with the folder cache (see owalib 
+        findFolders), the subfolders of the inbox (or the top of the mailbox) are listed 
+        again if the _inboxModified date (see getFolderCounts) (or the date of the root 
+        folder) has changed, deeper folders when the date listed with their parent has 
+        changed or after FolderCacheMaxAge seconds.
+        """
+        if not self.folderNames:
+            return [('Inbox', self.inboxPath)]
+        folders = []
+        rootModified = None
+        for name in self.folderNames:
+            parts = name.strip('/').split('/', 1)
+            if parts[0].lower() != 'inbox':
+                if rootModified is None:
+                    rootModified = self.owa.getFolderCounts(self.rootPath)['lastmodified'] or None
+                found = self.owa.findFolders(self.rootPath, name, self.folderCache.folders, 
+                                             rootModified, self.folderCacheAge)
+            elif len(parts) == 1:
+                found = [('Inbox', self.inboxPath)]
+            else:
+                # the name of the inbox depends on the language of the mailbox
+                found = [('Inbox/' + n, path) for n, path in 
+                         self.owa.findFolders(self.inboxPath, parts[1], self.folderCache.folders, 
+                                              _inboxModified, self.folderCacheAge)]
+            for folder in found:
+                if folder[1] not in [path for n, path in folders]:
+                    folders.append(folder)
+        self.folderCache.save()
+        return folders
+
+    def closeClones(self):
+        """
+        Close the connections which are cloned from the connection to the server.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        if self.ackOwa is not None:
+            self.ackOwa.close()
+            self.ackOwa = None
+
+    def close(self):
+        """
+        Close all connections (and the journal).
+        """
+        self.reset()
+        if self.journal is not None:
+            self.journal.close()
+
+    def run(self):
+        """
+        Fetch (or list) the messages and forward them.
+        Returns the number of messages which are found to download.
+        """
+        owa = self.owa
+        log = self.log
+        options = self.options
+        prop_dict = self.prop_dict
+        fetchAll = self.fetchAll
+        message_type = self.message_type
+        batchSize = self.batchSize
+        delete = self.delete
+
+        counts = self.getFolderCounts()
+        inboxPath = self.inboxPath
+        # the compressed and decompressed bytes received before this run
+        transferred = (owa.transferCounter.compressed, owa.transferCounter.decompressed)
+        cache = owa.messageCache
+        if cache is not None:
+            cached = (cache.hits, cache.misses, cache.hitBytes)
+
+        # the folders to fetch from and their number of messages, 
+        # the other folders than the inbox are counted concurrently (see imap)
+        def countFolders(_folders):
+            folderCounts = {inboxPath: counts}
+            for path, c in self.imap(lambda conn, path: conn.getFolderCounts(path), 
+                                     [path for name, path in _folders if path != inboxPath]):
+                folderCounts[path] = c
+            return folderCounts
+        folders = self.getFolders(counts['lastmodified'])
+        try:
+            folderCounts = countFolders(folders)
+        except owalib.SessionError:
+            if not self.folderNames:
+                raise
+            # a cached folder doesn't exist anymore (or the session expired), 
+            # find the folders again without the cache
+            log.debug('Could not count the messages of the folders, finding the folders again.')
+            self.folderCache.folders.clear()
+            folders = self.getFolders(counts['lastmodified'])
+            folderCounts = countFolders(folders)
+
+        # the delivered messages are acknowledged over a separate connection
+        if self.ackOwa is None and not options.ListOnly:
+            self.ackOwa = owa.clone()
+        ackOwa = self.ackOwa
+
+        # number of acknowledged messages (per folder) which no longer match the listing and 
+        # the number of messages being acknowledged (the listing runs at the same time, see deliverAll)
+        removed = dict([(path, 0) for name, path in folders])
+        acknowledging = dict([(path, 0) for name, path in folders])
+        # number of found messages
+        found = [0]
+        # number of messages and bytes scheduled to download (see MaxBytesPerRun)
+        scheduled = [0, 0]
+        deferred = [False]
+
+        def acknowledge(_delivered):
+            """
+            Mark the delivered messages as read (or delete them) with batch requests.
+            """
+            if self.journal is not None:
+                # the deliveries are on disk before they are acknowledged
+                self.journal.sync()
+            for name, path in folders:
+                delivered = [(i, m) for i, m in _delivered if m['folder'] == path]
+                if not delivered:
+                    continue
+                hrefs = [m['href'] for i, m in delivered]
+                if delete or not fetchAll:
+                    acknowledging[path] = len(hrefs)
+                try:
+                    if delete:
+                        results = ackOwa.deleteMessages(path, hrefs, batchSize)
+                        action = 'Deleted message %i.'
+                    else:
+                        results = ackOwa.markAsReadMany(path, hrefs, batchSize)
+                        action = 'Marked message %i read.'
+                    for i, m in delivered:
+                        href = m['href']
+                        if results[href]:
+                            log.info(action % i)
+                            if self.journal is not None:
+                                self.journal.record(Journal.ACKNOWLEDGED, href)
+                            if syncStates[path] is not None:
+                                syncStates[path].setProcessed(href)
+                            if delete or not fetchAll:
+                                removed[path] += 1
+                        else:
+                            log.warning('Could not acknowledge message %i.' % i)
+                finally:
+                    # only after the removed messages are counted, the listing 
+                    # may count too many removed messages but never too few
+                    acknowledging[path] = 0
+
+        # with incremental synchronisation only the messages after the watermark are listed
+        syncStates = dict([(path, None) for name, path in folders])
+        since = dict([(path, None) for name, path in folders])
+        if prop_dict.get('Incremental', 'false').lower() == 'true':
+            syncStateFile = os.path.expanduser(prop_dict.get('SyncStateFile', self.propertiesFile + '.sync'))
+            for name, path in folders:
+                if path == inboxPath:
+                    syncStates[path] = SyncState(syncStateFile)
+                else:
+                    # a state file for each of the other folders, named after its href
+                    syncStates[path] = SyncState('%s.%s' % (syncStateFile, hashlib.sha1(path).hexdigest()))
+                since[path] = syncStates[path].watermark
+                if since[path] is not None:
+                    log.debug('Listing messages created since %s' % since[path])
+
+        # nothing to do if there are no (new) messages
+        active = []
+        for name, path in folders:
+            c = folderCounts[path]
+            folderStamp = '%s/%s' % (c['visiblecount'], c['lastmodified'])
+            if (not fetchAll and c['unreadcount'] == 0) or \
+               (syncStates[path] is not None and fetchAll and syncStates[path].folderStamp == folderStamp):
+                continue
+            active.append((name, path))
+        if not active:
+            log.info('Found 0%s message(s).' % message_type)
+            return 0
+
+        # get the messages in the folders, in pages of PageSize messages if given,
+        # else the folders are listed concurrently (see imap)
+        def iterPages():
+            if self.pageSize > 0:
+                for name, path in active:
+                    for page in owa.iterListMessagePages(path, fetchAll, self.pageSize, 
+                                                         lambda path=path: removed[path] + acknowledging[path], 
+                                                         since[path], self.headers, self.query):
+                        yield name, path, page
+            else:
+                names = dict([(path, name) for name, path in active])
+                for path, page in self.imap(lambda conn, path: conn.getListMessages(path, fetchAll, since[path],
+                                                                                     self.headers, self.query), 
+                                            [path for name, path in active]):
+                    yield names[path], path, page
+
+        def iterMessages():
+            for name, path, page in iterPages():
+                syncState = syncStates[path]
+                if syncState is not None:
+                    page = [m for m in page if syncState.isNew(m)]
+                if path == inboxPath:
+                    log.info('Found %i%s message(s).' % (len(page), message_type) )
+                else:
+                    log.info('Found %i%s message(s) in %s.' % (len(page), message_type, name))
+                for m in page:
+                    m['folder'] = path
+                if self.rule is not None and not options.ListOnly:
+                    page, ruleDeferred = self.applyRule(page, syncState)
+                    if ruleDeferred:
+                        deferred[0] = True
+                page = self.schedule(page, syncState)
+                # only the messages to download count as found (see Scheduler poll)
+                found[0] += len(page)
+                for m in page:
+                    size = m['size'] or 0
+                    if self.maxBytesPerRun > 0 and scheduled[0] > 0 and \
+                       scheduled[1] + size > self.maxBytesPerRun:
+                        # the other messages are left for the next run
+                        log.info('Reached MaxBytesPerRun after %i message(s) of %i bytes.' % 
+                                 (scheduled[0], scheduled[1]))
+                        deferred[0] = True
+                        return
+                    scheduled[0] += 1
+                    scheduled[1] += size
+                    yield m
+
+        if options.ListOnly:
+            # only print message info
+            for i, m in enumerate(iterMessages()):
+                log.info('(%i) (%s)%s' % (i, m["fromemail"], m["subject"]))
+        else:
+            if self.journal is not None:
+                self.journal.compact()
+            try:
+                self.deliverAll(iterMessages(), acknowledge)
+            finally:
+                if self.journal is not None:
+                    self.journal.sync()
+
+        compressed = owa.transferCounter.compressed - transferred[0]
+        decompressed = owa.transferCounter.decompressed - transferred[1]
+        if compressed:
+            log.debug('Received %i compressed bytes for %i bytes (%.0f%% saved).' % 
+                      (compressed, decompressed, 100.0 * (1 - float(compressed) / max(1, decompressed))))
+        if cache is not None and cache.hits + cache.misses > cached[0] + cached[1]:
+            log.debug('Message cache: %i hit(s) (%i bytes), %i miss(es), %i bytes in cache.' % 
+                      (cache.hits - cached[0], cache.hitBytes - cached[2], cache.misses - cached[1], cache.size))
+
+        if not options.ListOnly:
+            for name, path in active:
+                syncState = syncStates[path]
+                if syncState is None:
+                    continue
+                # remember the state of the folder after processing to skip the next run if unchanged,
+                # unless messages may have arrived since the listing: then the number of messages
+                # differs from the number before the run minus the removed messages
+                before = folderCounts[path]['visiblecount']
+                counts = owa.getFolderCounts(path)
+                if before is not None and counts['visiblecount'] == before - removed[path]:
+                    syncState.folderStamp = '%s/%s' % (counts['visiblecount'], counts['lastmodified'])
+                else:
+                    syncState.folderStamp = None
+                if deferred[0]:
+                    # the next run has to list the folder for the messages left by MaxBytesPerRun
+                    syncState.folderStamp = None
+                syncState.save()
+
+        return found[0]
+
+class Scheduler(object):
+    """
+    Runs the fetchers of one or more accounts on a bounded number of worker threads.
+    Errors of an account are logged and don't stop the other accounts.
+    If a _statsFile is given the summary of the _stats is written to it after each run.
+    """
+    def __init__(self, _fetchers, _workers, _log, _stats = None, _statsFile = None):
+        self.fetchers = _fetchers
+        self.stats = _stats
+        self.statsFile = _statsFile
+        self.workers = max(1, min(_workers, len(_fetchers)))
+        self.log = _log
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # aggregate results
+        self.runs = 0
+        self.found = 0
+        self.failed = 0
+
+    def runFetcher(self, _fetcher):
+        """
+        Run the fetcher once. Returns the number of found messages or None on errors.
+        """
+        start = time.time()
+        try:
+            found = _fetcher.run()
+        except Exception, e:
+            # e.g. the connection was lost, start again with new connections
+            _fetcher.log.error('Fetching mail failed: %s: %s' % (e.__class__.__name__, e))
+            _fetcher.reset()
+            found = None
+        _fetcher.log.debug('Run took %.2f seconds.' % (time.time() - start))
+
+        self.lock.acquire()
+        try:
+            self.runs += 1
+            if found is None:
+                self.failed += 1
+            else:
+                self.found += found
+            if self.statsFile is not None:
+                self.stats.write(self.statsFile)
+        finally:
+            self.lock.release()
+        return found
+
+    def startWorkers(self, _target):
+        threads = [threading.Thread(target=_target) for i in range(self.workers)]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        return threads
+
+    def runAll(self):
+        """
+        Run all fetchers once.
+        """
+        fetchers = Queue.Queue()
+        for f in self.fetchers:
+            fetchers.put(f)
+
+        def worker():
+            while not self.stopped.isSet():
+                try:
+                    f = fetchers.get_nowait()
+                except Queue.Empty:
+                    return
+                self.runFetcher(f)
+
+        self.wait(self.startWorkers(worker))
+        self.log.info('Found %i message(s) for %i account(s), %i failed.' % 
+                      (self.found, len(self.fetchers), self.failed))
+
+    def poll(self, _interval, _maxInterval):
+        """
+        Keep fetching mail. After a run in which messages were found the next run 
+        of the account starts after _interval seconds, after each idle run (or error)
+        the waiting time of the account is doubled up to _maxInterval seconds.
+        """
+        # heap of (time of the next run, index, current interval) of the waiting fetchers
+        due = [(time.time(), i, _interval) for i in range(len(self.fetchers))]
+        condition = threading.Condition()
+
+        def worker():
+            while True:
+                condition.acquire()
+                try:
+                    while not self.stopped.isSet():
+                        now = time.time()
+                        if due and due[0][0] <= now:
+                            nextRun, i, wait = heapq.heappop(due)
+                            break
+                        condition.wait(due and due[0][0] - now or None)
+                    else:
+                        return
+                finally:
+                    condition.release()
+
+                fetcher = self.fetchers[i]
+                found = self.runFetcher(fetcher)
+                if found > 0:
+                    wait = _interval
+                else:
+                    wait = min(2 * wait, _maxInterval)
+                    # don't keep the SMTP connection open while idle
+                    if fetcher.ownsDelivery:
+                        fetcher.delivery.close()
+                fetcher.log.debug('Next run in %i seconds.' % wait)
+
+                condition.acquire()
+                try:
+                    heapq.heappush(due, (time.time() + wait, i, wait))
+                    condition.notify()
+                finally:
+                    condition.release()
+
+        threads = self.startWorkers(worker)
+        try:
+            self.wait(threads)
+        finally:
+            # let the workers finish their current run
+            condition.acquire()
+            try:
+                self.stopped.set()
+                condition.notifyAll()
+            finally:
+                condition.release()
+            self.wait(threads)
+
+    def wait(self, _threads):
+        # join with a timeout so the main thread can still be interrupted
+        for t in _threads:
+            while t.isAlive():
+                t.join(1)
+
+
 if __name__ == "__main__":
     # import the command line option parser
     from optparse import OptionParser
 
     # define the options parser options
-    usage = "usage: %prog [options] <properties-file>\n"
+    usage = "usage: %prog [options] <properties-file|directory> ...\n"
     parser = OptionParser(usage)
     parser.add_option("-p", "--print", action="store_true", dest="Print", help="Print properties. Print the properties found in the properties file.")
     parser.add_option("-s", "--silent", action="store_true", dest="Silent", help="Silent output. Only outputs error messages.")
     parser.add_option("-l", "--list", action="store_true", dest="ListOnly", help="Only list the messages.")
     parser.add_option("-a", "--all", action="store_true", dest="AllMessages", help="Fetch all messages (default: only unread messages)")
     parser.add_option("-v", "--verbose", action="store_true", dest="Verbose", help="Produce verbose output")
+    parser.add_option("-d", "--daemon", action="store_true", dest="Daemon", help="Keep running and poll the server for new mail.")
+    parser.add_option("-i", "--interval", type="int", dest="Interval", default=60, help="Seconds between the runs in daemon mode after new mail was found (default: 60)")
+    parser.add_option("--max-interval", type="int", dest="MaxInterval", default=600, help="Maximum number of seconds between the runs in daemon mode when no new mail is found (default: 600)")
+    parser.add_option("--stats", action="store_true", dest="Stats", help="Print statistics of the requests and deliveries at the end.")
+    parser.add_option("--stats-json", dest="StatsFile", metavar="FILE", help="Write the statistics as JSON to FILE (in daemon mode after each run).")
+    parser.add_option("-w", "--workers", type="int", dest="Workers", default=4, help="Maximum number of accounts which are processed at the same time (default: 4)")
     
     # parse the options
     (options, args) = parser.parse_args()
@@ -209,14 +2007,28 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(1)
     
-    # get the properties file and parse it
-    properties_file = args[0]
-    prop_dict = ParseProperties(properties_file)
+    # get the properties files, for a directory all *.properties files in it
+    properties_files = []
+    for arg in args:
+        if os.path.isdir(arg):
+            properties_files.extend([os.path.join(arg, f) for f in sorted(os.listdir(arg)) 
+                                     if f.endswith('.properties')])
+        else:
+            properties_files.append(arg)
+
+    # parse the properties files
+    accounts = []
+    for properties_file in properties_files:
+        prop_dict = ParseProperties(properties_file)
+        accounts.append( (properties_file, prop_dict) )
 
     # check if we should just print the properties
     if options.Print:
-      for key, value in prop_dict.iteritems():
-        print "%s: %s" % (key, value)
+      for properties_file, prop_dict in accounts:
+        if len(accounts) > 1:
+          print "[%s]" % properties_file
+        for key, value in prop_dict.iteritems():
+          print "%s: %s" % (key, value)
       sys.exit(0)
 
 
@@ -234,57 +2046,50 @@ if __name__ == "__main__":
     log.setLevel(logging.DEBUG)
     log.addHandler(console)
 
-    # get the full username with the domain part
-    fullUserName = "%s\\%s" % (prop_dict["Domain"], prop_dict["Username"])
-
-    # Create the OWA session
-    secure = prop_dict.get('Secure', 'false').lower() == 'true'
-    owa  = owalib.OWAConnectionClass(secure)(prop_dict["ExchangeServer"])
-
-    # Use Form Based Authentication (FBA)
-    password = prop_dict['Password'] 
-    exchangepath = prop_dict['ExchangePath'] 
-    fbapath = prop_dict.get('FBApath', '/exchweb/bin/auth/owaauth.dll')
-    owa.doFBA( fullUserName, password, exchangepath, fbapath)
-
-    # get the users root path on the server
-    rootpath = owa.getRootPath(prop_dict["ExchangePath"])
-    log.debug('Found user root path: %s' % rootpath)
-
-    # get the users inbox path
-    inboxPath = owa.getInboxPath(rootpath)
-    log.debug('Found inbox path: %s' % inboxPath)
-
-
-    # see which messages to list (default only unread)
-    if options.AllMessages or prop_dict.get("All",'false').lower() == 'true':
-        message_type = ""
-        fetchAll = True
-    else:
-        message_type = " unread"
-        fetchAll = False
-
-    # get a list of the messages in the inbox
-    inboxMessages =  owa.getListMessages(inboxPath, fetchAll)
-    log.info('Found %i%s message(s).' % (len(inboxMessages), message_type) )
-    
-    # loop over the messages
-    for i, m in enumerate(inboxMessages):
-        # only print message info 
-        if options.ListOnly:
-            log.info('(%i) (%s)%s' % (i, m["fromemail"], m["subject"]))
+    # the accounts with the same mail server share the delivery session
+    deliveries = {}
+    fetchers = []
+    for properties_file, prop_dict in accounts:
+        if len(accounts) > 1:
+            account = os.path.splitext(os.path.basename(properties_file))[0]
+            accountLog = logging.getLogger('FetchExc.%s' % account)
+            key = deliveryKey(prop_dict)
+            if key not in deliveries:
+                deliveries[key] = DeliverySession(prop_dict)
+            delivery = deliveries[key]
         else:
-            log.info('Sending mail %i: (%s)%s' % (i, m["fromemail"], m["subject"]))
-            message = owa.getMessage(m["href"])
-
-            sendMail(m["fromemail"],message, prop_dict)
-            
-            if prop_dict.get('Delete','false').lower() == 'true':
-                if(owa.deleteMessage(inboxPath, m["href"])):
-                    log.info('Deleted message %i.' % i)
-            else:
-                if(owa.markAsRead(inboxPath, m["href"])):
-                    log.info('Marked message %i read.' % i)
+            accountLog = log
+            delivery = None
+        fetchers.append(Fetcher(prop_dict, properties_file, options, accountLog, delivery))
 
+    stats = None
+    if options.Stats or options.StatsFile:
+        stats = Stats()
+        for fetcher in fetchers:
+            stats.attach(fetcher)
 
-    owa.close()
+    scheduler = Scheduler(fetchers, options.Workers, log, stats, options.StatsFile)
+    try:
+        if options.Daemon:
+            # stop cleanly when terminated
+            signal.signal(signal.SIGTERM, lambda _signum, _frame: sys.exit(0))
+            try:
+                scheduler.poll(options.Interval, max(options.Interval, options.MaxInterval))
+            except KeyboardInterrupt:
+                log.info('Stopped.')
+        elif len(fetchers) == 1:
+            fetchers[0].run()
+        else:
+            scheduler.runAll()
+            if scheduler.failed:
+                sys.exit(1)
+    finally:
+        for fetcher in fetchers:
+            fetcher.close()
+        for delivery in deliveries.values():
+            delivery.close()
+        if stats is not None:
+            if options.Stats:
+                print stats.format()
+            if options.StatsFile:
+                stats.write(options.StatsFile)
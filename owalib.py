@@ -40,26 +40,62 @@ Author: Pieter Kitslaar (c) 2009
 """
 
 import httplib
-import urllib2
-import cookielib
+import urllib
+import os
 import sys
 import re
+import time
+import shutil
+import tempfile
+import zlib
+import hashlib
+import threading
+import collections
+import Queue
+from xml.sax.saxutils import escape
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
 XML_CONTENT_TYPE = 'text/xml; charset="utf-8"'
 
+# the XML namespaces used in the responses of the server
+DAV_NS = 'DAV:'
+HTTPMAIL_NS = 'urn:schemas:httpmail:'
+MAILHEADER_NS = 'urn:schemas:mailheader:'
+
+# maximum number of message hrefs packed into a single BPROPPATCH/BDELETE request
+DEFAULT_BATCH_SIZE = 50
+
+def getTargetMsg(_filenames):
+    """
+    XML code for the <D:target> element of a (batch) request.
+    Each entry of _filenames is the full href of a message, only the last part is used.
+    """
+    hrefs = ''.join(['<D:href>%s</D:href>' % escape(f.split('/')[-1]) for f in _filenames])
+    return '<D:target>%s</D:target>' % hrefs
+
 def getDeleteMsg(_filename): 
     """
     XML code for a DELETE request to delete a message (no copy to "Trash", a real delete).
     Should be send to the "inbox", but _filename is the full href of the message.
     """
+    return getDeleteManyMsg([_filename])
+
+def getDeleteManyMsg(_filenames): 
+    """
+    XML code for a BDELETE request to delete several messages in one request.
+    Should be send to the "inbox", but the _filenames are the full hrefs of the messages.
+    """
 
     strBuf = """
     <?xml version="1.0" encoding="utf-8" ?>
     <D:delete xmlns:D="DAV:" xmlns:a="urn:schemas:httpmail:">
-        <D:target><D:href>%s</D:href></D:target>
+        %s
     </D:delete>
     """
-    return strBuf % _filename.split('/')[-1]
+    return strBuf % getTargetMsg(_filenames)
 
 
 def getMarkAsReadMsg(_filename):
@@ -67,15 +103,22 @@ def getMarkAsReadMsg(_filename):
     XML code for a BPROPPATCH request to mark a message as read.
     Should be send to the "inbox", but _filename is the full href of the message.
     """ 
+    return getMarkAsReadManyMsg([_filename])
+
+def getMarkAsReadManyMsg(_filenames):
+    """
+    XML code for a BPROPPATCH request to mark several messages as read in one request.
+    Should be send to the "inbox", but the _filenames are the full hrefs of the messages.
+    """ 
 
     strBuf = """ 
     <?xml version="1.0" encoding="utf-8" ?>
     <D:propertyupdate xmlns:D="DAV:" xmlns:a="urn:schemas:httpmail:">
-      <D:target><D:href>%s</D:href></D:target>
+      %s
       <D:set><D:prop><a:read>1</a:read></D:prop></D:set>
     </D:propertyupdate>
     """
-    return strBuf % _filename.split('/')[-1]
+    return strBuf % getTargetMsg(_filenames)
 
 def getInboxMsg(): 
     """
@@ -91,10 +134,62 @@ def getInboxMsg():
     </D:propfind>"""
     return strBuf
 
-def getListMailMsg(_allMsgs = False): 
+# format of the dates used by the server, e.g. DAV:creationdate ("2009-01-31T12:00:00.000Z")
+DATE_FORMAT = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?Z?$')
+
+def getFolderCountsMsg(): 
+    """
+    XML code for a PROPFIND request to obtain the number of (unread) messages 
+    and the last modification date of a folder.
+    """ 
+
+    strBuf = """
+    <?xml version="1.0" encoding="utf-8" ?>
+    <D:propfind xmlns:D="DAV:" xmlns:a="urn:schemas:httpmail:">
+      <D:prop>
+        <a:unreadcount/>
+        <D:visiblecount/>
+        <D:getlastmodified/>
+      </D:prop>
+    </D:propfind>"""
+    return strBuf
+
+def getSubFoldersMsg(): 
+    """
+    XML code for a SEARCH request (with "Depth: 1") to get the subfolders of a folder.
+    """
+
+    strBuf = """
+    <?xml version="1.0" encoding="utf-8" ?>
+    <searchrequest xmlns="DAV:">
+      <sql>
+        SELECT 
+            "DAV:displayname", 
+            "DAV:getlastmodified", 
+            "DAV:hassubs"
+        FROM ""
+        WHERE &quot;DAV:iscollection&quot; = True AND &quot;DAV:ishidden&quot; = False
+      </sql>
+    </searchrequest>"""
+    return strBuf
+
+# default number of seconds the cached subfolders of a folder are used without a 
+# fresh modification date to check them against (see findFolders)
+DEFAULT_FOLDER_CACHE_AGE = 3600
+
+# the names of the headers which can be requested with the urn:schemas:mailheader: namespace
+HEADER_NAME = re.compile(r'^[A-Za-z0-9-]+$')
+
+def getListMailMsg(_allMsgs = False, _since = None, _headers = (), _query = None): 
     """
     XML code for a SEARCH request to get all the messages in a folder.
     If _allMsgs == True it will return all messages. Else only the unread messages.
+    If _since is given (a date like "2009-01-31T12:00:00.000Z") only the messages 
+    created at or after that date are returned.
+    The values of the _headers (names like "Message-ID" or "List-Id") of each message 
+    are returned as well, see iterParseMessages.
+    If a _query is given only the messages which match its conditions are returned,
+    with the columns selected by the query (see Query).
     """
 
     strBuf = """
@@ -104,7 +199,10 @@ def getListMailMsg(_allMsgs = False):
         SELECT 
             "urn:schemas:httpmail:fromemail", 
             "urn:schemas:httpmail:subject", 
-            "urn:schemas:httpmail:read" 
+            "urn:schemas:httpmail:read",
+            "DAV:creationdate",
+            "DAV:getcontentlength",
+            "urn:schemas:httpmail:datereceived"%s
         FROM ""
         WHERE &quot;DAV:iscollection&quot; = False AND &quot;DAV:ishidden&quot; = False
         %s
@@ -115,8 +213,177 @@ def getListMailMsg(_allMsgs = False):
     and_statement = ""
     if not _allMsgs:
         and_statement = """ AND "urn:schemas:httpmail:read"= False"""
-    return strBuf % and_statement
+    if _since is not None:
+        if not DATE_FORMAT.match(_since):
+            raise ValueError("Invalid date: %s" % _since)
+        and_statement += """ AND "DAV:creationdate" &gt;= CAST("%s" as 'dateTime.tz')""" % _since
+    columns = ""
+    for header in _headers:
+        if not HEADER_NAME.match(header):
+            raise ValueError("Invalid header name: %s" % header)
+        columns += ',\n            "%s%s"' % (MAILHEADER_NS, header.lower())
+    if _query is not None:
+        and_statement += _query.sql()
+        for column in _query.columns:
+            columns += ',\n            "%s"' % column
+    return strBuf % (columns, and_statement)
+
+# the names of the properties which can be used in a query, like "urn:schemas:httpmail:subject"
+PROPERTY_NAME = re.compile(r'^[\w.-]+(:|/)[\w:./-]*[\w-]$')
+
+def propertyXmlName(_property):
+    """
+    Returns the name of the XML element of a property ("urn:schemas:httpmail:subject"), 
+    the namespace is the part up to the last ':' or '/'.
+    """
+    i = max(_property.rfind(':'), _property.rfind('/')) + 1
+    return xmlName(_property[:i], _property[i:])
+
+class Query(object):
+    """
+    The conditions of a getListMailMsg SEARCH request, so the server only returns the 
+    messages which match instead of all messages. The conditions are combined with AND 
+    and each method returns the query, so the calls can be chained:
+        Query().fromAddress('a@example.com', 'b@example.com').subjectLike('%report%')
+    The values are escaped, the properties are full names like "urn:schemas:httpmail:subject".
+    Other properties of the messages can be listed with select, their values are 
+    available by their full name in the MessageInfo (see iterParseMessages).
+    """
+    OPERATORS = ('=', '<>', '<', '<=', '>', '>=', 'LIKE')
+
+    def __init__(self):
+        self.conditions = []
+        self.columns = []
+
+    def checkProperty(self, _property):
+        if not PROPERTY_NAME.match(_property):
+            raise ValueError("Invalid property name: %s" % _property)
+
+    def checkOperator(self, _operator):
+        if _operator not in Query.OPERATORS:
+            raise ValueError("Invalid operator: %s" % _operator)
+
+    def literal(self, _value):
+        """
+        Returns the Exchange SQL literal of a string, number or boolean.
+        """
+        if isinstance(_value, bool):
+            return str(_value)
+        if isinstance(_value, (int, long)):
+            return str(_value)
+        if isinstance(_value, unicode):
+            _value = _value.encode('utf-8')
+        if not isinstance(_value, str):
+            raise ValueError("Invalid value: %r" % (_value,))
+        return "'%s'" % _value.replace("'", "''")
+
+    def where(self, _property, _operator, _value):
+        """
+        Only list the messages with a property which compares to the _value 
+        (a string, number or boolean) with the _operator (see OPERATORS).
+        """
+        self.checkProperty(_property)
+        self.checkOperator(_operator)
+        self.conditions.append('"%s" %s %s' % (_property, _operator, self.literal(_value)))
+        return self
+
+    def whereAny(self, _property, _values):
+        """
+        Only list the messages with a property which is equal to one of the _values.
+        """
+        self.checkProperty(_property)
+        if not _values:
+            raise ValueError("No values for %s" % _property)
+        self.conditions.append('(%s)' % ' OR '.join(['"%s" = %s' % (_property, self.literal(value)) 
+                                                     for value in _values]))
+        return self
+
+    def whereDate(self, _property, _operator, _date):
+        """
+        Only list the messages with a date property which compares to the _date 
+        (like "2009-01-31T12:00:00.000Z") with the _operator.
+        """
+        self.checkProperty(_property)
+        self.checkOperator(_operator)
+        if not DATE_FORMAT.match(_date):
+            raise ValueError("Invalid date: %s" % _date)
+        self.conditions.append('"%s" %s CAST("%s" as \'dateTime.tz\')' % (_property, _operator, _date))
+        return self
+
+    def select(self, *_properties):
+        """
+        List the values of the _properties as well.
+        """
+        for p in _properties:
+            self.checkProperty(p)
+        self.columns.extend(_properties)
+        return self
+
+    def fromAddress(self, *_addresses):
+        """
+        Only list the messages from one of the _addresses.
+        """
+        return self.whereAny(HTTPMAIL_NS + 'fromemail', _addresses)
+
+    def subjectLike(self, _pattern):
+        """
+        Only list the messages with a subject which matches the _pattern (% matches any text).
+        """
+        return self.where(HTTPMAIL_NS + 'subject', 'LIKE', _pattern)
+
+    def receivedSince(self, _date):
+        """
+        Only list the messages received at or after the _date.
+        """
+        return self.whereDate(HTTPMAIL_NS + 'datereceived', '>=', _date)
+
+    def receivedBefore(self, _date):
+        """
+        Only list the messages received before the _date.
+        """
+        return self.whereDate(HTTPMAIL_NS + 'datereceived', '<', _date)
+
+    def minSize(self, _size):
+        """
+        Only list the messages of at least _size bytes.
+        """
+        return self.where(DAV_NS + 'getcontentlength', '>=', int(_size))
 
+    def maxSize(self, _size):
+        """
+        Only list the messages of at most _size bytes.
+        """
+        return self.where(DAV_NS + 'getcontentlength', '<=', int(_size))
+
+    def sql(self):
+        """
+        Returns the (XML escaped) conditions to add to the WHERE clause.
+        """
+        return ''.join([' AND %s' % escape(condition) for condition in self.conditions])
+
+
+# default number of messages per SEARCH request when listing messages in pages
+DEFAULT_PAGE_SIZE = 500
+
+def parseContentRange(_value):
+    """
+    Parse the Content-Range header of a response to a SEARCH request with a Range 
+    header ("rows 0-499; total=1438"). Returns a (first row, last row, total rows) 
+    tuple, the values are None if they are not available.
+    """
+    m = re.match(r'\s*rows\s+(\d+)-(\d+)(?:\s*;\s*total\s*=\s*(\d+))?', _value or '')
+    if not m:
+        return None, None, None
+    first, last, total = m.groups()
+    if total is not None:
+        total = int(total)
+    return int(first), int(last), total
+
+# messages larger than this number of bytes are spooled to a temporary file
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+
+# number of bytes read at once from a response
+CHUNK_SIZE = 64 * 1024
 
 # list of characters with their substitute HEX code for nicer href strings
 FIX_REPLACE = []
@@ -139,6 +406,495 @@ def fixFileName(_fileName):
         result = result.replace(repl[0], repl[1])
     return result 
 
+def messageName(_href):
+    """
+    Returns the name of a message (the unquoted last part of its href).
+    Used to match the hrefs in a multistatus response with the requested hrefs.
+    """
+    return urllib.unquote(_href.rstrip('/').split('/')[-1])
+
+def xmlName(_namespace, _name):
+    """
+    Returns the name of an XML element as used by ElementTree ("{namespace}name").
+    """
+    return '{%s}%s' % (_namespace, _name)
+
+def xmlText(_text):
+    """
+    Returns the text of an XML element as an (utf-8 encoded) string.
+    """
+    if _text is None:
+        return ''
+    if isinstance(_text, unicode):
+        return _text.encode('utf-8')
+    return _text
+
+# regexps to find the start tag of the <multistatus> element and the end tags 
+# of the <response> elements, independent of the namespace prefix used
+MULTISTATUS_START = re.compile(r'<((?:[\w.-]+:)?multistatus)\b[^>]*>')
+RESPONSE_END = re.compile(r'</(?:[\w.-]+:)?response\s*>')
+
+def iterMultiStatus(_file):
+    """
+    Parse a 207 multistatus response incrementally from the file-like object _file.
+    The namespace prefixes and layout used by the server don't matter.
+
+    This is a generator which yields a (href, status codes, properties) tuple 
+    for each <response> element. The status codes are the integer codes of all 
+    status lines in the response, the properties are a dictionary of the 
+    properties with a 2xx status (see xmlName for the keys).
+    """
+    responseName = xmlName(DAV_NS, 'response')
+    propstatName = xmlName(DAV_NS, 'propstat')
+    statusName = xmlName(DAV_NS, 'status')
+    propName = xmlName(DAV_NS, 'prop')
+    hrefName = xmlName(DAV_NS, 'href')
+
+    # The response is read in chunks. All complete <response> elements in the 
+    # buffer are parsed at once, wrapped in the start tag of the <multistatus> 
+    # element (to keep the namespace declarations) and its end tag.
+    head = None
+    buf = ''
+    data = True
+    while data:
+        data = _file.read(CHUNK_SIZE)
+        buf += data
+
+        if head is None:
+            m = MULTISTATUS_START.search(buf)
+            if not m:
+                continue
+            head = buf[:m.end()]
+            tail = '</%s>' % m.group(1)
+            buf = buf[m.end():]
+
+        last = None
+        for last in RESPONSE_END.finditer(buf):
+            pass
+        if last is None:
+            continue
+        root = ElementTree.fromstring(head + buf[:last.end()] + tail)
+        buf = buf[last.end():]
+
+        for elem in root:
+            if elem.tag != responseName:
+                continue
+            codes = []
+            props = {}
+            for child in elem:
+                if child.tag == propstatName:
+                    code = parseStatus(child.findtext(statusName))
+                    codes.append(code)
+                    prop = child.find(propName)
+                    if prop is not None and code // 100 == 2:
+                        for p in prop:
+                            text = p.text
+                            if text.__class__ is not str:
+                                text = xmlText(text)
+                            props[p.tag] = text
+                elif child.tag == statusName:
+                    codes.append(parseStatus(child.text))
+            yield xmlText(elem.findtext(hrefName)), codes, props
+
+def parseStatus(_statusLine):
+    """
+    Returns the integer status code of a status line ("HTTP/1.1 200 OK") or 0.
+    """
+    try:
+        return int(_statusLine.split()[1])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+def parseMultiStatus(_file, _accept = ()):
+    """
+    Parse the body of a 207 multistatus response to a batch request from the file-like _file.
+    Returns a dictionary which maps the name of each message (see messageName) 
+    to True if all the status lines of its response are 2xx (or in _accept), else False.
+    """
+    result = {}
+    for href, codes, props in iterMultiStatus(_file):
+        result[messageName(href)] = len(codes) > 0 and \
+                                    all([code // 100 == 2 or code in _accept for code in codes])
+    return result
+
+class MessageInfo(object):
+    """
+    The information of a message in a listing (see iterParseMessages). 
+    A compact record (no dictionary per message) with the attributes 'href', 'fromemail', 
+    'subject', 'creationdate', 'size' (in bytes, None if unknown), 'datereceived' and 
+    'folder' (the href of the folder, only set by the caller), which can also be used 
+    as a dictionary:
+    message['href'], message.get('subject'), 'href' in message and dict(message).
+    Other fields (like the 'headers' of a listing) are kept in the dictionary 'extra', 
+    which is only created when a message has other fields.
+    """
+    FIELDS = ('href', 'fromemail', 'subject', 'creationdate', 'size', 'datereceived', 'folder')
+    DEFAULTS = ('', '', '', '', None, '', '')
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, _href, _fromemail = '', _subject = '', _creationdate = '', 
+                 _size = None, _datereceived = '', _extra = None):
+        self.href = _href
+        self.fromemail = _fromemail
+        self.subject = _subject
+        self.creationdate = _creationdate
+        self.size = _size
+        self.datereceived = _datereceived
+        self.folder = ''
+        self.extra = _extra or None
+
+    def __getitem__(self, _key):
+        if _key in MessageInfo.FIELDS:
+            return getattr(self, _key)
+        if self.extra is not None:
+            return self.extra[_key]
+        raise KeyError(_key)
+
+    def __setitem__(self, _key, _value):
+        if _key in MessageInfo.FIELDS:
+            setattr(self, _key, _value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[_key] = _value
+
+    def get(self, _key, _default = None):
+        try:
+            return self[_key]
+        except KeyError:
+            return _default
+
+    def __contains__(self, _key):
+        return _key in MessageInfo.FIELDS or (self.extra is not None and _key in self.extra)
+
+    def keys(self):
+        return list(MessageInfo.FIELDS) + list(self.extra or ())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __eq__(self, _other):
+        if isinstance(_other, (MessageInfo, dict)):
+            return dict(self.items()) == dict(_other.items())
+        return NotImplemented
+
+    def __ne__(self, _other):
+        result = self.__eq__(_other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return dict(self.items())
+
+    def __setstate__(self, _state):
+        extra = dict(_state)
+        for key, default in zip(MessageInfo.FIELDS, MessageInfo.DEFAULTS):
+            setattr(self, key, extra.pop(key, default))
+        self.extra = extra or None
+
+    def __repr__(self):
+        return 'MessageInfo(%r)' % dict(self.items())
+
+def iterParseMessages(_file, _headers = (), _query = None):
+    """
+    Parse the multistatus response to a getListMailMsg SEARCH request from the file-like _file.
+    This is a generator which yields a MessageInfo with 'href', 'fromemail', 'subject',
+    'creationdate', 'size' and 'datereceived' for each message. 
+    If _headers are given (see getListMailMsg) the MessageInfo also has 'headers': 
+    a dictionary with the (lower case) header names and their values ('' if missing).
+    The values of the columns selected by the _query are available by their full name.
+    The sender addresses are interned, a message from the same sender shares the string.
+    """
+    headers = [(header.lower(), xmlName(MAILHEADER_NS, header.lower())) for header in _headers]
+    columns = []
+    if _query is not None:
+        columns = [(column, propertyXmlName(column)) for column in _query.columns]
+    fromemail = xmlName(HTTPMAIL_NS, 'fromemail')
+    subject = xmlName(HTTPMAIL_NS, 'subject')
+    creationdate = xmlName(DAV_NS, 'creationdate')
+    getcontentlength = xmlName(DAV_NS, 'getcontentlength')
+    datereceived = xmlName(HTTPMAIL_NS, 'datereceived')
+    for href, codes, props in iterMultiStatus(_file):
+        try:
+            size = int(props[getcontentlength])
+        except (KeyError, ValueError):
+            size = None
+        extra = None
+        if headers or columns:
+            extra = dict([(column, props.get(name, '')) for column, name in columns])
+            if headers:
+                extra['headers'] = dict([(header, props.get(name, '')) for header, name in headers])
+        yield MessageInfo(href, 
+                          intern(props.get(fromemail, '')), 
+                          props.get(subject, ''),
+                          props.get(creationdate, ''),
+                          size,
+                          props.get(datereceived, ''),
+                          extra)
+
+# default maximum total size of the messages in a MessageCache (in bytes)
+DEFAULT_CACHE_SIZE = 100 * 1024 * 1024
+
+class MessageCache(object):
+    """
+    Cache of the raw text of the messages in a directory, so a message which is 
+    downloaded again (e.g. when all messages are fetched again or after a failed 
+    delivery) is read from the disk instead of the server.
+    A message is stored in a file named after the SHA-1 of its href and a version,
+    which should identify the message (e.g. its creation date and size), as the server
+    can reuse the href of a deleted message. Messages without a version are not cached.
+    The least recently used messages are removed when the total size exceeds _maxBytes,
+    the modification time of the files keeps the order between runs.
+    A connection and its clones share the cache (see getMessage and getMessageStream).
+    """
+    def __init__(self, _directory, _maxBytes = DEFAULT_CACHE_SIZE):
+        self.directory = _directory
+        self.maxBytes = _maxBytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # number of bytes read from the cache instead of the server
+        self.hitBytes = 0
+        if not os.path.isdir(_directory):
+            os.makedirs(_directory, 0700)
+
+        # the sizes of the cached messages, least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        files = []
+        for name in os.listdir(_directory):
+            path = os.path.join(_directory, name)
+            if name.endswith('.tmp'):
+                # left by an interrupted put
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            files.append( (st.st_mtime, name, st.st_size) )
+        for mtime, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        self.evict()
+
+    def key(self, _href, _version):
+        return hashlib.sha1('%s\n%s' % (_href, _version)).hexdigest()
+
+    def get(self, _href, _version = None):
+        """
+        Returns the cached message as a file opened for reading, None if it is not in the cache
+        (or if there is no _version).
+        """
+        if not _version:
+            return None
+        key = self.key(_href, _version)
+        self.lock.acquire()
+        try:
+            size = self.entries.pop(key, None)
+            if size is not None:
+                try:
+                    f = open(os.path.join(self.directory, key), 'rb')
+                    os.utime(f.name, None)
+                except EnvironmentError:
+                    # removed by someone else
+                    self.size -= size
+                    size = None
+            if size is None:
+                self.misses += 1
+                return None
+            self.entries[key] = size
+            self.hits += 1
+            self.hitBytes += size
+            return f
+        finally:
+            self.lock.release()
+
+    def put(self, _href, _version, _message):
+        """
+        Store the _message, a string or a file-like object (which is read from its 
+        current position). Returns False if the message could not be stored (the 
+        cache is only an optimization, so errors like a full disk are ignored).
+        A message without a _version is never stored.
+        """
+        if not _version:
+            return False
+        key = self.key(_href, _version)
+        tmpName = None
+        try:
+            fd, tmpName = tempfile.mkstemp('.tmp', key, self.directory)
+            f = os.fdopen(fd, 'wb')
+            try:
+                if isinstance(_message, str):
+                    f.write(_message)
+                else:
+                    shutil.copyfileobj(_message, f, CHUNK_SIZE)
+                size = f.tell()
+            finally:
+                f.close()
+            if size > self.maxBytes:
+                os.remove(tmpName)
+                return False
+            os.rename(tmpName, os.path.join(self.directory, key))
+        except EnvironmentError:
+            if tmpName is not None and os.path.exists(tmpName):
+                os.remove(tmpName)
+            return False
+
+        self.lock.acquire()
+        try:
+            self.size += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.evict()
+        finally:
+            self.lock.release()
+        return True
+
+    def evict(self):
+        """
+        Remove the least recently used messages until the total size is below maxBytes.
+        """
+        while self.size > self.maxBytes and self.entries:
+            key, size = self.entries.popitem(False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.directory, key))
+            except OSError:
+                pass
+
+# status codes of the server when the authentication cookie is not (or no longer) valid, 
+# 440 is the "Login Timeout" status of Exchange form based authentication
+AUTH_FAILED_STATUS = (401, 440)
+
+# the requests with these methods are sent again when the connection fails,
+# BPROPPATCH only sets properties and a BDELETE of a deleted message returns 404
+RETRY_METHODS = ('GET', 'PROPFIND', 'SEARCH', 'BPROPPATCH', 'BDELETE')
+# default number of times a request is sent again and the delay (in seconds)
+# before the second retry, which doubles for each following retry
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 0.5
+
+# value of the Accept-Encoding header when compression is enabled
+ACCEPT_ENCODING = 'gzip, deflate'
+
+class TransferCounter(object):
+    """
+    Counts the number of bytes of the compressed responses as received from the 
+    server and after decompression. Shared by a connection and its clones.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.compressed = 0
+        self.decompressed = 0
+
+    def add(self, _compressed, _decompressed):
+        self.lock.acquire()
+        try:
+            self.compressed += _compressed
+            self.decompressed += _decompressed
+        finally:
+            self.lock.release()
+
+class DecompressingResponse(object):
+    """
+    Wraps a httplib.HTTPResponse with a gzip or deflate Content-Encoding.
+    The body is decompressed incrementally while it is read, so it can be 
+    used by the streaming readers (like iterMultiStatus and getMessageStream).
+    The other attributes are those of the wrapped response.
+    """
+    def __init__(self, _response, _encoding, _counter):
+        self.response = _response
+        self.encoding = _encoding
+        self.counter = _counter
+        self.decompressor = None
+        self.buffer = ''
+        self.eof = False
+
+    def __getattr__(self, _name):
+        return getattr(self.response, _name)
+
+    def _decompress(self, _data):
+        if self.decompressor is None:
+            if self.encoding == 'deflate' and not (len(_data) >= 2 and ord(_data[0]) & 0x0f == 8 and 
+                                                   (ord(_data[0]) << 8 | ord(_data[1])) % 31 == 0):
+                # the data is not zlib wrapped, some servers send raw deflate data
+                wbits = -zlib.MAX_WBITS
+            elif self.encoding == 'deflate':
+                wbits = zlib.MAX_WBITS
+            else:
+                # gzip header and trailer
+                wbits = 16 + zlib.MAX_WBITS
+            self.decompressor = zlib.decompressobj(wbits)
+        return self.decompressor.decompress(_data)
+
+    def read(self, amt=None):
+        while not self.eof and (amt is None or len(self.buffer) < amt):
+            data = self.response.read(CHUNK_SIZE)
+            if not data:
+                self.eof = True
+                if self.decompressor is not None:
+                    self.buffer += self.decompressor.flush()
+                break
+            decompressed = self._decompress(data)
+            self.counter.add(len(data), len(decompressed))
+            self.buffer += decompressed
+        if amt is None:
+            amt = len(self.buffer)
+        data = self.buffer[:amt]
+        self.buffer = self.buffer[amt:]
+        return data
+
+class CountingResponse(object):
+    """
+    Wraps a httplib.HTTPResponse and counts the bytes of the body in the 'received'
+    entry of the request record (see do_request) while the body is read.
+    The other attributes are those of the wrapped response.
+    """
+    def __init__(self, _response, _record):
+        self.response = _response
+        self.record = _record
+
+    def __getattr__(self, _name):
+        return getattr(self.response, _name)
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        self.record['received'] += len(data)
+        return data
+
+class SessionError(ValueError):
+    """
+    Raised when the server indicates that the authentication cookie is no longer 
+    valid (status 401 or 440 "Login Timeout") or that a path doesn't exist (404).
+    Authenticating again (and discovering the paths again) could solve this.
+    """
+    pass
+
+def checkStatus(_resp, _expected, _pathError = True):
+    """
+    Check the status of the response against the _expected status codes. 
+    Raises a SessionError when the authentication failed (401 or 440) or when 
+    the path doesn't exist (404, unless _pathError == False), else a ValueError
+    for an unexpected status. The response is read in that case, to make sure
+    the connection can be used for another request.
+    """
+    status = _resp.status
+    if status in _expected:
+        return
+    _resp.read()
+    if status in AUTH_FAILED_STATUS:
+        raise SessionError("Authentication failed (status = %s). Exiting!" % status)
+    elif status == 404 and _pathError:
+        raise SessionError("Path doesn't exist. Exiting!")
+    else:
+        raise ValueError("Status = %s. Exiting!" % status)
+
 class OWAConnectionPlugin(object):
     """
     Plugin class to connect to a Outlook Web Access page using WebDAV.
@@ -154,6 +910,18 @@ class OWAConnectionPlugin(object):
         s.__init__(*args, **kw)
         
         self.authentication_header = None
+        # ask the server to compress the responses (gzip or deflate)
+        self.compression = False
+        self.transferCounter = TransferCounter()
+        # see do_request
+        self.retries = DEFAULT_RETRIES
+        self.retryDelay = DEFAULT_RETRY_DELAY
+        # the arguments of doFBA to authenticate again, shared with the clones
+        self.fbaState = {'args': None, 'lock': threading.Lock()}
+        # callables which are called with a record of each request, shared with the clones
+        self.requestHooks = []
+        # see getMessage, shared with the clones
+        self.messageCache = None
 
     def doFBA(self, _username, _password, _exchangePath, _fbaPath):
         """
@@ -164,17 +932,25 @@ class OWAConnectionPlugin(object):
         http://pxa-be.blogspot.com/2008/07/exchange-form-based-authentication-and.html
         """
 
+        # only needed here (and not when a cached authentication cookie is used)
+        import urllib2
+        import cookielib
+
         handlerType = (urllib2.HTTPHandler, urllib2.HTTPSHandler)[self.secure]
         protocol = ('http://', 'https://')[self.secure]
+        # the server name with the port (if it is not the default port)
+        host = self.host
+        if self.port != (httplib.HTTP_PORT, httplib.HTTPS_PORT)[self.secure]:
+            host = '%s:%s' % (self.host, self.port)
         
-        # init the CookieJar and register it with the url openner
+        # init the CookieJar with its own url opener (not installed globally, 
+        # as several accounts can log in at the same time on different threads)
         cj = cookielib.CookieJar()
         opener = urllib2.build_opener(handlerType(),urllib2.HTTPCookieProcessor(cj))
-        urllib2.install_opener(opener)
 
         # define the body of the request setting the username and password
         owabody = ''
-        owabody += 'destination=' + protocol + self.host + '/' + _exchangePath + '/'
+        owabody += 'destination=' + protocol + host + '/' + _exchangePath + '/'
         owabody += '&username=' + _username
         owabody += '&password=' + _password
 
@@ -183,12 +959,12 @@ class OWAConnectionPlugin(object):
         owaheaders = {'Content-Type': 'application/x-www-form-urlencoded',
         'Connection': 'Keep-Alive',
         'User-Agent': 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.2; .NET CLR 1.1.4322)',
-        'Host': self.host}
+        'Host': host}
 
         # define the url and make the request
-        owaurl = protocol+self.host+_fbaPath
+        owaurl = protocol+host+_fbaPath
         owareq = urllib2.Request(owaurl,owabody,owaheaders)
-        owa = urllib2.urlopen(owareq)
+        owa = opener.open(owareq)
 
         # get the cookie from the jar
         cookie_string = ''
@@ -197,33 +973,128 @@ class OWAConnectionPlugin(object):
 
         # add the cookie to the authentication_header
         # this will be used in subsequent calls to the server
-        self.authentication_header  = {'Cookie': cookie_string}
+        # (the header is updated in place to share it with the clones)
+        if self.authentication_header is None:
+            self.authentication_header = {}
+        self.authentication_header['Cookie'] = cookie_string
+        self.fbaState['args'] = (_username, _password, _exchangePath, _fbaPath)
+
+    def reauthenticate(self, _cookie):
+        """
+        Authenticate again with the arguments of the last doFBA call, 
+        unless the cookie has already been renewed by a clone since _cookie was sent.
+        """
+        lock = self.fbaState['lock']
+        lock.acquire()
+        try:
+            if self.authentication_header is None or \
+               self.authentication_header.get('Cookie') == _cookie:
+                self.doFBA(*self.fbaState['args'])
+        finally:
+            lock.release()
+
 
+    def clone(self):
+        """
+        Returns a new connection to the same server which shares the authentication cookie.
+        """
+        conn = self.__class__(self.host, self.port)
+        conn.authentication_header = self.authentication_header
+        conn.compression = self.compression
+        conn.transferCounter = self.transferCounter
+        conn.retries = self.retries
+        conn.retryDelay = self.retryDelay
+        conn.fbaState = self.fbaState
+        conn.requestHooks = self.requestHooks
+        conn.messageCache = self.messageCache
+        return conn
 
     def do_request(self, method, url, body=None, extra_hdrs={}):
         """
         Make a request to the server.
+
+        If the connection fails (e.g. the server closed a keep-alive connection), 
+        requests with a method in RETRY_METHODS are sent again over a new connection,
+        at most self.retries times, with an exponential backoff starting at 
+        self.retryDelay seconds after the first retry.
+        If the server no longer accepts the authentication cookie (401 or 440) and 
+        doFBA was used, the authentication is done again and the request repeated once.
+
+        Each of the self.requestHooks is called with a dictionary which describes the 
+        request: 'method', 'url', 'status' (None if the request failed), 'time' (seconds 
+        until the response headers are received, including retries), 'sent' and 'received' 
+        (number of bytes of the body, 'received' is updated while the body is read), 
+        'retries' and 'reauthenticated'.
         """
-        request_header = extra_hdrs.copy()
-        if self.authentication_header != None:
-            request_header.update(self.authentication_header)
-        self.request(method, url, body, request_header)
-        return self.getresponse()
+        start = time.time()
+        retries = 0
+        if method in RETRY_METHODS:
+            retries = self.retries
+        attempt = 0
+        reauthenticated = False
+        while True:
+            request_header = extra_hdrs.copy()
+            if self.authentication_header != None:
+                request_header.update(self.authentication_header)
+            if self.compression:
+                request_header.setdefault('Accept-Encoding', ACCEPT_ENCODING)
+            try:
+                self.request(method, url, body, request_header)
+                resp = self.getresponse()
+
+                if resp.status in AUTH_FAILED_STATUS and not reauthenticated and \
+                   self.fbaState['args'] is not None:
+                    resp.read()
+                    self.reauthenticate(request_header.get('Cookie'))
+                    reauthenticated = True
+                    continue
+            except (httplib.HTTPException, IOError):
+                # (socket and urllib2 errors are IOErrors)
+                # the state of the connection is unknown, a new one is opened by the next request
+                self.close()
+                if attempt >= retries:
+                    exc_info = sys.exc_info()
+                    if self.requestHooks:
+                        self.callHooks(method, url, body, None, start, attempt, reauthenticated)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if attempt > 0:
+                    time.sleep(self.retryDelay * 2 ** (attempt - 1))
+                attempt += 1
+                continue
+            break
+
+        if self.requestHooks:
+            record = self.callHooks(method, url, body, resp.status, start, attempt, reauthenticated)
+            resp = CountingResponse(resp, record)
+        if self.compression:
+            encoding = (resp.getheader('Content-Encoding') or '').strip().lower()
+            if encoding in ('gzip', 'x-gzip', 'deflate'):
+                return DecompressingResponse(resp, encoding.replace('x-', ''), self.transferCounter)
+        return resp
     
+    def callHooks(self, _method, _url, _body, _status, _start, _retries, _reauthenticated):
+        """
+        Call the request hooks (see do_request), returns the record of the request.
+        """
+        record = {'method': _method, 'url': _url, 'status': _status, 
+                  'time': time.time() - _start, 'sent': len(_body or ''), 'received': 0, 
+                  'retries': _retries, 'reauthenticated': _reauthenticated}
+        for hook in self.requestHooks:
+            hook(record)
+        return record
+
+    def checkStatus(self, _resp, _expected, _pathError = True):
+        """
+        Check the status of the response (see the checkStatus function).
+        """
+        checkStatus(_resp, _expected, _pathError)
+
     def getRootPath(self, _pRootPath):
         """
         Return the user's root path on the server based on the given exchange path.
         """
         resp = self.do_request('GET', "/" + _pRootPath + "/")
-        status = resp.status
-        if status == 401:
-            raise ValueError("Authentication failed. Exiting!")
-        elif status == 404:
-            raise ValueError("Exchange user path doesn't exist. Exiting!")
-        elif status == 200:
-            pass
-        else:
-            raise ValueError("Status = %s. Exiting!" % status)
+        self.checkStatus(resp, (200,))
 
         # get the respons text
         text = resp.read()
@@ -247,56 +1118,240 @@ class OWAConnectionPlugin(object):
         hrd['Depth'] = '1'
         hrd['Content-Type'] = XML_CONTENT_TYPE
         resp = self.do_request('PROPFIND', _rootPath, getInboxMsg(), hrd)
+        self.checkStatus(resp, (207,))
 
-        if resp.status != 207:
-            #self.log.error("Wrong stats (%s). Exiting!" % resp.status)
-            sys.exit(1)
+        inbox = xmlName(HTTPMAIL_NS, 'inbox')
+        for href, codes, props in iterMultiStatus(resp):
+            if inbox in props:
+                resp.read()
+                return props[inbox]
 
-        xml  = resp.read()
+        raise ValueError("Could not find inbox path. Exiting!")
 
-        a = re.compile(r'<d:inbox>([^<]+)</d:inbox>')
-        m = a.search(xml)
+    def getFolderCounts(self, _folderPath):
+        """
+        Returns the number of unread and visible messages and the last modification date
+        of the folder with a single (small) PROPFIND request. Returns a dictionary with keys:
+        'unreadcount', 'visiblecount' (integers, None if not available) and 'lastmodified'.
+        """
+        hrd = {'Depth': '0', 'Content-Type': XML_CONTENT_TYPE }
+        resp = self.do_request('PROPFIND', _folderPath, getFolderCountsMsg(), hrd)
+        self.checkStatus(resp, (207,))
 
-        if not m:
-            raise ValueError("Could not find inbox path. Exiting!")
-        
-        return m.groups()[0]
+        props = {}
+        for href, codes, p in iterMultiStatus(resp):
+            props.update(p)
+        resp.read()
+
+        counts = {'lastmodified': props.get(xmlName(DAV_NS, 'getlastmodified'), '')}
+        for key, name in [('unreadcount', xmlName(HTTPMAIL_NS, 'unreadcount')),
+                          ('visiblecount', xmlName(DAV_NS, 'visiblecount'))]:
+            try:
+                counts[key] = int(props[name])
+            except (KeyError, ValueError):
+                counts[key] = None
+        return counts
+
+    def getSubFolders(self, _folderPath):
+        """
+        Returns the (direct) subfolders of a folder with a single SEARCH request.
+        Returns a list of dictionaries with keys: 'href', 'name' (the display name),
+        'lastmodified' and 'hassubs' (True if the folder has subfolders).
+        """
+        hrd = {'Depth': '1', 'Content-Type': XML_CONTENT_TYPE }
+        resp = self.do_request('SEARCH', _folderPath, getSubFoldersMsg(), hrd)
+        self.checkStatus(resp, (207,))
+
+        displayname = xmlName(DAV_NS, 'displayname')
+        lastmodified = xmlName(DAV_NS, 'getlastmodified')
+        hassubs = xmlName(DAV_NS, 'hassubs')
+        folders = []
+        for href, codes, props in iterMultiStatus(resp):
+            folders.append({'href': href.rstrip('/'), 
+                            'name': props.get(displayname) or urllib.unquote(href.rstrip('/').split('/')[-1]),
+                            'lastmodified': props.get(lastmodified, ''),
+                            'hassubs': props.get(hassubs) in ('1', 'true')})
+        resp.read()
+        return folders
+
+    def findFolders(self, _folderPath, _name, _cache = None, _lastmodified = None, 
+                    _maxAge = DEFAULT_FOLDER_CACHE_AGE):
+        """
+        Returns the folders with the _name relative to the folder _folderPath: the display 
+        names of the folders separated by '/' ("Lists/python"), "*" matches any folder.
+        Returns a list of (name, href) tuples, the names are relative to _folderPath.
+
+        The subfolders of each folder on the way are listed with getSubFolders. If a _cache
+        (a dictionary) is given the subfolders are stored in it by the href of the folder and
+        only listed again when the last modification date of the folder has changed. 
+        For _folderPath that date is _lastmodified (e.g. from getFolderCounts), for a subfolder
+        it is the date listed with its parent, but only if the parent was listed again in 
+        this call. Without a fresh date the cached subfolders are listed again when they 
+        are older than _maxAge seconds (see getCachedSubFolders).
+        A folder which no longer exists should be handled by clearing the _cache.
+        """
+        folders = [('', _folderPath, _lastmodified)]
+        for part in _name.strip('/').split('/'):
+            found = []
+            for name, href, lastmodified in folders:
+                cached = _cache is not None and _cache.get(href)
+                subFolders = self.getCachedSubFolders(href, _cache, lastmodified, _maxAge)
+                # the dates of the subfolders are only fresh if they were listed now
+                fresh = _cache is None or _cache.get(href) is not cached
+                for folder in subFolders:
+                    if part == '*' or folder['name'].lower() == part.lower():
+                        found.append((name and name + '/' + folder['name'] or folder['name'], 
+                                      folder['href'], fresh and folder['lastmodified'] or None))
+            folders = found
+        if not folders:
+            raise ValueError("Could not find folder %s. Exiting!" % _name)
+        return [(name, href) for name, href, lastmodified in folders]
 
-    def getListMessages(self, _inboxPath, _all = False):
+    def getCachedSubFolders(self, _folderPath, _cache = None, _lastmodified = None, 
+                            _maxAge = DEFAULT_FOLDER_CACHE_AGE):
+        """
+        Returns the subfolders of a folder (see getSubFolders) from the _cache (see findFolders).
+        If the _lastmodified date of the folder is given, the cached subfolders are used
+        if the cached date is the same, else if they were listed less than _maxAge seconds ago.
+        """
+        if _cache is None:
+            return self.getSubFolders(_folderPath)
+        cached = _cache.get(_folderPath)
+        if cached is not None:
+            if _lastmodified is not None:
+                valid = cached['lastmodified'] == _lastmodified
+            else:
+                valid = 0 <= time.time() - cached.get('listed', 0) < _maxAge
+            if valid:
+                return cached['folders']
+        folders = self.getSubFolders(_folderPath)
+        _cache[_folderPath] = {'lastmodified': _lastmodified or '', 'listed': time.time(), 
+                               'folders': folders}
+        return folders
+
+    def iterListMessages(self, _inboxPath, _all = False, _since = None, _headers = (), _query = None):
         """
         Returns the url, subject and fromemail of the unread (or all) messages in the _inboxPath.
-        Returns a list of dictionaries with keys: 'href', 'fromemail' and 'subject'
+        If _since is given, only the messages created at or after that date (see getListMailMsg).
+        The values of the _headers are returned in the same request (see iterParseMessages).
+        If a _query is given only the messages which match it are listed (see Query).
+        This is a generator which parses the response of the server incrementally and 
+        yields a MessageInfo (see iterParseMessages) for each message.
+        N.B. The connection can't be used for other requests until the generator is exhausted.
         """
         hrd = {'Depth': '1', 'Content-Type': XML_CONTENT_TYPE }
-        resp = self.do_request('SEARCH', _inboxPath, getListMailMsg(_all), hrd)
-        xml =  resp.read()
+        resp = self.do_request('SEARCH', _inboxPath, getListMailMsg(_all, _since, _headers, _query), hrd)
+        self.checkStatus(resp, (207,))
 
-        # regexp to find each response body
-        a = re.compile(r'<a:response>(.+?)</a:response>')
-        # regeexp to find the "href", "fromemail" and "subject" contents
-        b = re.compile(r'<a:href>(?P<href>.+?)</a:href>.*?<d:fromemail>(?P<fromemail>.+?)</d:fromemail>.*?(<d:subject>(?P<subject>.*?)</d:subject>|<d:subject/>)')
+        for message in iterParseMessages(resp, _headers, _query):
+            yield message
+        resp.read()
 
-        raw_list =  a.findall(xml)
+    def iterListMessagePages(self, _inboxPath, _all = False, _pageSize = DEFAULT_PAGE_SIZE, 
+                             _removed = None, _since = None, _headers = (), _query = None):
+        """
+        Returns the url, subject and fromemail of the unread (or all) messages in the _inboxPath
+        in pages of at most _pageSize messages, using the "Range: rows=first-last" header.
+        This is a generator which yields a list of MessageInfo records (see getListMessages) for each
+        page. The next page is only requested when the previous page has been consumed.
 
-        messages = []
-        for item in raw_list:
-            m = b.search(item)
-            if not m:
-                print "Could not match regexp in: %s" % item
-                continue
-            mail_dict = {}
-            mail_dict.update(m.groupdict())
-            messages.append( mail_dict )
+        If listed messages are removed from the result while listing (marked as read or deleted),
+        _removed should be a callable which returns the number of removed messages. It is used 
+        to correct the first row of the next page. When messages are removed at the same time
+        it should include the messages of the requests in progress: counting too many only 
+        lists some messages again, counting too few skips messages.
+        If _since is given, only the messages created at or after that date (see getListMailMsg).
+        The values of the _headers are returned in the same requests (see iterParseMessages).
+        If a _query is given only the messages which match it are listed (see Query).
+        """
+        hrd = {'Depth': '1', 'Content-Type': XML_CONTENT_TYPE }
+        listed = 0
+        seen = set()
+        while True:
+            first = listed
+            if _removed is not None:
+                first = max(0, first - _removed())
+            hrd['Range'] = 'rows=%i-%i' % (first, first + _pageSize - 1)
+            resp = self.do_request('SEARCH', _inboxPath, getListMailMsg(_all, _since, _headers, _query), hrd)
+            if resp.status == 416:
+                # requested range not satisfiable, there are no more rows
+                resp.read()
+                break
+            self.checkStatus(resp, (206, 207))
 
-        return messages
+            rows = list(iterParseMessages(resp, _headers, _query))
+            resp.read()
+            # skip the messages which are listed twice because the rows shifted
+            page = [m for m in rows if m['href'] not in seen]
+            seen.update([m['href'] for m in page])
+            listed += len(page)
+            yield page
 
-    def getMessage(self, _messagePath):
+            first, last, total = parseContentRange(resp.getheader('Content-Range'))
+            if resp.status == 207 or len(rows) < _pageSize:
+                # the range is ignored by the server or this was the last page
+                break
+            if total is not None and last is not None and last + 1 >= total:
+                break
+
+    def getListMessages(self, _inboxPath, _all = False, _since = None, _headers = (), _query = None):
+        """
+        Returns the url, subject and fromemail of the unread (or all) messages in the _inboxPath.
+        If _since is given, only the messages created at or after that date (see getListMailMsg).
+        The values of the _headers are returned in the same request (see iterParseMessages).
+        If a _query is given only the messages which match it are listed (see Query).
+        Returns a list of MessageInfo records (which can be used as dictionaries) with the 
+        keys: 'href', 'fromemail', 'subject', 'creationdate', 'size' and 'datereceived'
+        """
+        return list(self.iterListMessages(_inboxPath, _all, _since, _headers, _query))
+
+    def getMessage(self, _messagePath, _version = None):
         """
         Return the raw text of the message.
+        If the connection has a messageCache the message is read from it if it is 
+        cached (under the _version, see MessageCache), else it is stored in it.
         """
+        cache = self.messageCache
+        if cache is not None:
+            cached = cache.get(_messagePath, _version)
+            if cached is not None:
+                try:
+                    return cached.read()
+                finally:
+                    cached.close()
+
         hdr = {'Translate': 'F'}
         resp = self.do_request('GET', _messagePath, "", hdr)
-        return resp.read()
+        self.checkStatus(resp, (200,), False)
+        text = resp.read()
+        if cache is not None:
+            cache.put(_messagePath, _version, text)
+        return text
+
+    def getMessageStream(self, _messagePath, _spoolSize = DEFAULT_SPOOL_SIZE, _version = None):
+        """
+        Return the raw text of the message as a file-like object.
+        The message is read from the server in chunks. Messages larger than _spoolSize
+        bytes are spooled to a temporary file instead of being kept in memory.
+        A cached message is returned as the file in the messageCache (see getMessage).
+        The caller should close the returned object.
+        """
+        cache = self.messageCache
+        if cache is not None:
+            cached = cache.get(_messagePath, _version)
+            if cached is not None:
+                return cached
+
+        hdr = {'Translate': 'F'}
+        resp = self.do_request('GET', _messagePath, "", hdr)
+        self.checkStatus(resp, (200,), False)
+        spool = tempfile.SpooledTemporaryFile(_spoolSize)
+        shutil.copyfileobj(resp, spool, CHUNK_SIZE)
+        if cache is not None:
+            spool.seek(0)
+            cache.put(_messagePath, _version, spool)
+        spool.seek(0)
+        return spool
 
     def markAsRead(self, _inboxPath, _messagePath):
         """
@@ -319,6 +1374,50 @@ class OWAConnectionPlugin(object):
         resp.read()
         return resp.status == 207
 
+    def _batchRequest(self, _method, _xmlFunc, _inboxPath, _messagePaths, _batchSize, _accept = ()):
+        """
+        Send a batch request (BPROPPATCH or BDELETE) for the _messagePaths,
+        packing at most _batchSize hrefs in each request.
+        Returns a dictionary which maps each message path to True on success 
+        (a 2xx status or a status in _accept).
+        """
+        hdr = {'Content-type': XML_CONTENT_TYPE}
+        results = {}
+        for start in range(0, len(_messagePaths), _batchSize):
+            batch = _messagePaths[start:start + _batchSize]
+            resp = self.do_request(_method, _inboxPath + '/', _xmlFunc(batch), hdr)
+            statuses = {}
+            if resp.status == 207:
+                statuses = parseMultiStatus(resp, _accept)
+            elif resp.status in AUTH_FAILED_STATUS:
+                self.checkStatus(resp, (207,))
+            resp.read() # read (the rest) to make sure we can do another request
+            for path in batch:
+                results[path] = statuses.get(messageName(path), False)
+        return results
+
+    def markAsReadMany(self, _inboxPath, _messagePaths, _batchSize = DEFAULT_BATCH_SIZE):
+        """
+        Mark several messages as read, using one BPROPPATCH request per _batchSize messages.
+        Requires the path to the "inbox" and a list of full paths to the messages.
+        Returns a dictionary which maps each message path to True if it was marked as read.
+        """
+        return self._batchRequest('BPROPPATCH', getMarkAsReadManyMsg, 
+                                  _inboxPath, _messagePaths, _batchSize)
+
+    def deleteMessages(self, _inboxPath, _messagePaths, _batchSize = DEFAULT_BATCH_SIZE):
+        """
+        Delete several messages on the server, using one BDELETE request per _batchSize messages.
+        N.B. Does not move the messages to "Trash" really deletes them!
+
+        Requires the path to the "inbox" and a list of full paths to the messages.
+        Returns a dictionary which maps each message path to True if it was deleted.
+        A message which doesn't exist (404) counts as deleted, e.g. when the request 
+        is sent again after a connection failure.
+        """
+        return self._batchRequest('BDELETE', getDeleteManyMsg, 
+                                  _inboxPath, _messagePaths, _batchSize, (404,))
+
 
 class PlainOWAConnection(OWAConnectionPlugin, httplib.HTTPConnection, object):
     """ OWAConnection class for non-SSL (http://) connections """
@@ -328,6 +1427,119 @@ class SecureOWAConnection(OWAConnectionPlugin, httplib.HTTPSConnection, object):
     """ OWAConnection class for secure SSL (https://) connections """
     secure = True
 
+# default number of connections in an OWAConnectionPool
+DEFAULT_POOL_SIZE = 4
+
+class OWAConnectionPool(object):
+    """
+    Pool of connections to the server of an (authenticated) OWA connection.
+    All connections of the pool share the authentication cookie captured by doFBA
+    on the given connection. The given connection itself is not used by the pool.
+
+    Each connection is used by its own worker thread. Use imap or fetchMany to 
+    make requests concurrently and call close when the pool is no longer needed.
+    """
+    def __init__(self, _connection, _size = DEFAULT_POOL_SIZE):
+        self.connections = [_connection.clone() for i in range(_size)]
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for conn in self.connections:
+            t = threading.Thread(target=self._worker, args=(conn,))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self, _conn):
+        """
+        Worker thread, handles the tasks (call, index, item) put in the task queue.
+        """
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            call, index, item = task
+            if call['cancelled']:
+                continue
+            try:
+                call['results'].put( (index, item, call['function'](_conn, item), None) )
+            except Exception:
+                # the connection could be halfway a response
+                _conn.close()
+                call['results'].put( (index, item, None, sys.exc_info()) )
+
+    def imap(self, _function, _items, _ordered = True):
+        """
+        Calls _function(connection, item) for each of the _items, concurrently on the 
+        connections of the pool. This is a generator which yields (item, result) tuples,
+        in the order of _items if _ordered == True, else as soon as they complete.
+        Exceptions raised by _function are re-raised in the calling thread.
+        """
+        call = {'function': _function, 'results': Queue.Queue(), 'cancelled': False}
+
+        # limit the number of outstanding results to bound the memory usage
+        window = 2 * len(self.connections)
+        items = iter(_items)
+        submitted = 0
+        yielded = 0
+        done = {}
+        try:
+            while True:
+                # keep the workers busy
+                while submitted - yielded < window:
+                    try:
+                        item = items.next()
+                    except StopIteration:
+                        break
+                    self.tasks.put( (call, submitted, item) )
+                    submitted += 1
+                if yielded == submitted:
+                    break
+
+                index, item, result, exc_info = call['results'].get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if not _ordered:
+                    yielded += 1
+                    yield item, result
+                    continue
+
+                done[index] = (item, result)
+                while yielded in done:
+                    item, result = done.pop(yielded)
+                    yielded += 1
+                    yield item, result
+        finally:
+            # skip the tasks which are still pending
+            call['cancelled'] = True
+
+    def fetchMany(self, _messagePaths, _ordered = True):
+        """
+        Download the messages concurrently. 
+        This is a generator which yields (messagePath, raw text of the message) tuples.
+        See imap for the meaning of _ordered.
+        """
+        return self.imap(lambda conn, path: conn.getMessage(path), _messagePaths, _ordered)
+
+    def streamMany(self, _messagePaths, _ordered = True, _spoolSize = DEFAULT_SPOOL_SIZE):
+        """
+        Download the messages concurrently, see getMessageStream.
+        This is a generator which yields (messagePath, file-like object) tuples.
+        See imap for the meaning of _ordered.
+        """
+        return self.imap(lambda conn, path: conn.getMessageStream(path, _spoolSize), 
+                         _messagePaths, _ordered)
+
+    def close(self):
+        """
+        Stop the worker threads and close all connections of the pool.
+        """
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        for conn in self.connections:
+            conn.close()
+
 def OWAConnectionClass(_secure):
     """ Factory method to return the correct connection class based on the _secure argument. """
     if _secure: